@@ -0,0 +1,143 @@
+# benchmark.py
+#
+# Сравнение режима auto с постоянным использованием deepseek-reasoner:
+# задержка и стоимость на наборе промптов.
+#
+#   python benchmark.py prompts.txt            # один промпт на строку
+#   python benchmark.py prompts.txt --dry-run  # только решения маршрутизатора, без запросов к API
+#   python benchmark.py --check                # проверка маршрутизатора на эталонных промптах
+
+import argparse
+import asyncio
+import sys
+import time
+
+from openai import AsyncOpenAI
+
+from config import OPENAI_API_KEY, OPENAI_BASE_URL
+from utils import calculate_cost, calculate_prompt_cost, parse_usage, choose_model, num_tokens_from_messages
+
+# Эталонные промпты для проверки маршрутизатора: экономия в бенчмарке имеет смысл,
+# только если обычные реплики не уходят в reasoner, а код и математика — уходят
+ROUTING_SAMPLES = [
+    ("Let's talk about the weather", "deepseek-chat"),
+    ("Create a short poem about autumn", "deepseek-chat"),
+    ("Update me on the news", "deepseek-chat"),
+    ("Select a good movie for tonight", "deepseek-chat"),
+    ("Class schedule for monday?", "deepseek-chat"),
+    ("Private jets are expensive, right?", "deepseek-chat"),
+    ("Import duties in Germany?", "deepseek-chat"),
+    ("Привет; как дела;", "deepseek-chat"),
+    ("Встреча 12/05 в силе?", "deepseek-chat"),
+    ("Что купить: $5 и $10 подарки?", "deepseek-chat"),
+    ("Посоветуй фильм вроде Матрицы", "deepseek-chat"),
+    ("Я решил поехать в отпуск, куда лучше?", "deepseek-chat"),
+    ("Москва => Питер, сколько ехать?", "deepseek-chat"),
+    ("Как дела?", "deepseek-chat"),
+    ("def parse(line):\n    return line.split()", "deepseek-reasoner"),
+    ("import numpy as np\nprint(np.zeros(3))", "deepseek-reasoner"),
+    ("from collections import Counter", "deepseek-reasoner"),
+    ("const total = items.reduce((a, b) => a + b, 0);", "deepseek-reasoner"),
+    ("SELECT id, name FROM users WHERE age > 30", "deepseek-reasoner"),
+    ("Traceback (most recent call last):\n  File \"main.py\", line 1", "deepseek-reasoner"),
+    ("public static void main(String[] args) {", "deepseek-reasoner"),
+    ("Чему равно 2^10 * 3?", "deepseek-reasoner"),
+    ("Найди $x^2 + 1 = 5$", "deepseek-reasoner"),
+    ("Реши уравнение 3x + 5 = 20", "deepseek-reasoner"),
+    ("Докажи, что корень из 2 иррационален", "deepseek-reasoner"),
+]
+
+
+def check_routing():
+    """
+    Прогон choose_model по ROUTING_SAMPLES
+
+    Returns:
+        int: Количество промптов, отправленных не в ожидаемую модель
+    """
+    errors = 0
+    for prompt, expected in ROUTING_SAMPLES:
+        model, reason = choose_model(prompt)
+        mark = "ok  " if model == expected else "FAIL"
+        errors += model != expected
+        print(f"{mark} {model:<18} {reason:<18} {prompt[:60]!r}")
+    print(f"\nОшибок маршрутизации: {errors} из {len(ROUTING_SAMPLES)}")
+    return errors
+
+
+async def run_prompt(client, model, prompt):
+    """
+    Один запрос к модели
+
+    Returns:
+        tuple: (задержка в секундах, стоимость в долларах)
+    """
+    messages = [{"role": "user", "content": prompt}]
+    start_time = time.perf_counter()
+    response = await client.chat.completions.create(model=model, messages=messages, temperature=0.7)
+    latency = time.perf_counter() - start_time
+
+    answer = response.choices[0].message.content or ""
+    tokens_out = num_tokens_from_messages([{"role": "assistant", "content": answer}], model=model)
+    usage = parse_usage(response.usage, model, messages, tokens_out)
+    cost = calculate_prompt_cost(model, usage["cache_hit_tokens"], usage["cache_miss_tokens"])
+    cost += calculate_cost(model, usage["completion_tokens"], token_type="output")
+    return latency, round(cost, 6)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Auto routing vs always deepseek-reasoner")
+    parser.add_argument("prompts", nargs="?", help="Файл с промптами, по одному на строку")
+    parser.add_argument("--dry-run", action="store_true", help="Показать только выбор модели")
+    parser.add_argument("--check", action="store_true", help="Проверить маршрутизатор на ROUTING_SAMPLES")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(1 if check_routing() else 0)
+    if not args.prompts:
+        parser.error("prompts file is required")
+
+    with open(args.prompts, encoding="utf-8") as f:
+        prompts = [line.strip() for line in f if line.strip()]
+
+    routes = [choose_model(prompt) for prompt in prompts]
+    if args.dry_run:
+        for prompt, (model, reason) in zip(prompts, routes):
+            print(f"{model:<18} {reason:<18} {prompt[:60]}")
+        chat_share = sum(model == "deepseek-chat" for model, _ in routes) / max(len(routes), 1)
+        print(f"\nВ deepseek-chat уходит {chat_share:.0%} запросов")
+        return
+
+    client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+    totals = {"reasoner": [0.0, 0.0], "auto": [0.0, 0.0]}
+    for prompt, (model, reason) in zip(prompts, routes):
+        reasoner_latency, reasoner_cost = await run_prompt(client, "deepseek-reasoner", prompt)
+        if model == "deepseek-reasoner":
+            # Запрос совпадает с эталонным, повторно не отправляем
+            auto_latency, auto_cost = reasoner_latency, reasoner_cost
+        else:
+            auto_latency, auto_cost = await run_prompt(client, model, prompt)
+
+        totals["reasoner"][0] += reasoner_latency
+        totals["reasoner"][1] += reasoner_cost
+        totals["auto"][0] += auto_latency
+        totals["auto"][1] += auto_cost
+        print(
+            f"{model:<18} {reason:<18} "
+            f"reasoner {reasoner_latency:6.2f}s ${reasoner_cost:.6f} | "
+            f"auto {auto_latency:6.2f}s ${auto_cost:.6f} | {prompt[:40]}"
+        )
+
+    reasoner_latency, reasoner_cost = totals["reasoner"]
+    auto_latency, auto_cost = totals["auto"]
+    print(f"\nВсегда reasoner: {reasoner_latency:.2f}s, ${reasoner_cost:.6f}")
+    print(f"Auto:            {auto_latency:.2f}s, ${auto_cost:.6f}")
+    if reasoner_latency and reasoner_cost:
+        print(
+            f"Экономия: задержка {1 - auto_latency / reasoner_latency:.0%}, "
+            f"стоимость {1 - auto_cost / reasoner_cost:.0%}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,13 +4,20 @@ TELEGRAM_BOT_TOKEN = "key"
 OPENAI_API_KEY = "key"
 SECRET_KEYWORD = "key"
 
-# Модель по умолчанию для новых пользователей
+# Telegram ID администраторов (доступ к /usage all, /profile и другим служебным командам)
+ADMIN_USER_IDS = []
+
+# Модель, назначаемая пользователю при /auth (deepseek-chat, deepseek-reasoner или auto)
 OPENAI_MODEL = "deepseek-chat"
 
 # Если используешь альтернативного провайдера — укажи URL
 OPENAI_BASE_URL = "https://api.deepseek.com"  # по умолчанию
 
 #context - узнать контекст
+#export - выгрузить диалог файлом
+#usage - расход токенов и кэш
+#search - поиск по истории
 #model - выбрать модель
 #new - новый контекст
+#compare - сравнить ответы двух моделей
 #test_long_message - тест сообщений
\ No newline at end of file
@@ -1,13 +1,21 @@
 # database.py
 
 import sqlite3
+import json
 import logging
 import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from utils import num_tokens_from_messages
+
 DB_FOLDER = os.getenv("DB_FOLDER", "bd")
 DB_NAME = "chatgpt_telegram_log.db"
 DB_PATH = os.path.join(DB_FOLDER, DB_NAME)
+# Количество файлов БД (шардов), между которыми распределяются пользователи.
+# 1 — все данные в одном файле DB_PATH
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
 
 if not os.path.exists(DB_FOLDER):
     os.makedirs(DB_FOLDER)
@@ -20,12 +28,53 @@ def _execute_sql(conn, sql, params=None):
         conn.commit()
         return cursor
     except sqlite3.Error as e:
-        logging.error(f"SQL execution error: {e}")
+        logging.error("SQL execution error: %s", e)
         raise
 
-def init_db():
-    """Инициализация базы данных с таблицами и индексами"""
-    with sqlite3.connect(DB_PATH) as conn:
+def _shard_path(index):
+    """Путь к файлу шарда с номером index"""
+    name, ext = os.path.splitext(DB_NAME)
+    return os.path.join(DB_FOLDER, f"{name}_shard{index}{ext}")
+
+def get_db_path(user_id):
+    """Путь к файлу БД, в котором хранятся данные пользователя"""
+    if DB_SHARDS <= 1:
+        return DB_PATH
+    return _shard_path(zlib.crc32(str(user_id).encode()) % DB_SHARDS)
+
+def get_all_db_paths():
+    """Пути ко всем файлам БД (всем шардам)"""
+    if DB_SHARDS <= 1:
+        return [DB_PATH]
+    return [_shard_path(index) for index in range(DB_SHARDS)]
+
+def _fan_out(func, paths=None):
+    """
+    Параллельно выполняет func(path) для каждого файла БД и объединяет результаты
+
+    Args:
+        func: Функция, принимающая путь к файлу БД и возвращающая список
+        paths: Файлы БД; по умолчанию — все шарды
+    """
+    paths = paths or get_all_db_paths()
+    if len(paths) == 1:
+        return func(paths[0])
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        return [row for rows in executor.map(func, paths) for row in rows]
+
+def init_db(user_id=None):
+    """Инициализация базы данных с таблицами и индексами
+
+    Args:
+        user_id: Инициализировать только шард этого пользователя; None — все шарды
+    """
+    paths = [get_db_path(user_id)] if user_id is not None else get_all_db_paths()
+    for path in paths:
+        _init_db_file(path)
+
+def _init_db_file(path):
+    """Создание таблиц, индексов и полнотекстового индекса в одном файле БД"""
+    with sqlite3.connect(path) as conn:
         try:
             # Создаем таблицы
             tables = [
@@ -48,6 +97,9 @@ def init_db():
                     cost REAL NOT NULL CHECK (cost >= 0),
                     timestamp REAL NOT NULL,
                     model_name TEXT NOT NULL,
+                    cache_hit_tokens INTEGER NOT NULL DEFAULT 0,
+                    cache_miss_tokens INTEGER NOT NULL DEFAULT 0,
+                    purpose TEXT NOT NULL DEFAULT 'dialog' CHECK (purpose IN ('dialog', 'map', 'compare')),
                     FOREIGN KEY(user_id) REFERENCES user_settings(user_id) ON DELETE CASCADE
                 )
                 ''',
@@ -59,8 +111,17 @@ def init_db():
                     role TEXT NOT NULL CHECK (role IN ('user', 'assistant')),
                     content TEXT NOT NULL,
                     timestamp REAL NOT NULL,
+                    tokens INTEGER,
                     FOREIGN KEY(user_id) REFERENCES user_settings(user_id) ON DELETE CASCADE
                 )
+                ''',
+                '''
+                CREATE TABLE IF NOT EXISTS context_windows (
+                    user_id INTEGER NOT NULL,
+                    conversation_id TEXT NOT NULL,
+                    start_id INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, conversation_id)
+                )
                 '''
             ]
 
@@ -76,16 +137,179 @@ def init_db():
             for table_sql in tables:
                 _execute_sql(conn, table_sql)
             
+            # Добавляем колонки, появившиеся после создания таблиц
+            cursor = _execute_sql(conn, "PRAGMA table_info(interactions)")
+            interaction_columns = {col[1] for col in cursor.fetchall()}
+            for column in ('cache_hit_tokens', 'cache_miss_tokens'):
+                if column not in interaction_columns:
+                    _execute_sql(conn,
+                        f'ALTER TABLE interactions ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+            if 'purpose' not in interaction_columns:
+                # Старые записи нельзя разметить задним числом — они считаются репликами диалога
+                _execute_sql(conn,
+                    "ALTER TABLE interactions ADD COLUMN purpose TEXT NOT NULL DEFAULT 'dialog'")
+            cursor = _execute_sql(conn, "PRAGMA table_info(conversation_context)")
+            if 'tokens' not in {col[1] for col in cursor.fetchall()}:
+                # Для старых записей токены считаются при первом чтении окна контекста
+                _execute_sql(conn, 'ALTER TABLE conversation_context ADD COLUMN tokens INTEGER')
+
             for index_sql in indexes:
                 _execute_sql(conn, index_sql)
 
+            _init_search_index(conn)
+
         except sqlite3.Error as e:
-            logging.error(f"Database initialization error: {e}")
+            logging.error("Database initialization error: %s", e)
+            raise
+
+# Текст для полнотекстового индекса: ответы reasoner хранятся как JSON {"reasoning", "answer"}
+_FTS_CONTENT_SQL = '''
+    CASE WHEN json_valid({row}.content) AND json_type({row}.content, '$.answer') IS NOT NULL
+         THEN json_extract({row}.content, '$.answer') ELSE {row}.content END
+'''
+_FTS_REASONING_SQL = '''
+    CASE WHEN json_valid({row}.content) AND json_type({row}.content, '$.reasoning') IS NOT NULL
+         THEN json_extract({row}.content, '$.reasoning') ELSE '' END
+'''
+
+def _init_search_index(conn):
+    """
+    Полнотекстовый индекс FTS5 по промптам и ответам (включая рассуждения reasoner).
+    Синхронизируется триггерами; при первом создании заполняется из interactions.
+    Колонка owner содержит 'u<user_id>' и позволяет искать только по истории пользователя.
+    """
+    cursor = _execute_sql(conn,
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='interactions_fts'")
+    exists = cursor.fetchone() is not None
+
+    try:
+        _execute_sql(conn, '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS interactions_fts USING fts5(
+                content,
+                reasoning,
+                owner,
+                conversation_id UNINDEXED,
+                timestamp UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite собран без FTS5 — поиск будет недоступен, остальное работает
+        logging.warning("FTS5 is not available, /search disabled: %s", e)
+        return
+
+    columns = "rowid, content, reasoning, owner, conversation_id, timestamp"
+    values = (f"new.id, {_FTS_CONTENT_SQL.format(row='new')}, {_FTS_REASONING_SQL.format(row='new')}, "
+              f"'u' || new.user_id, new.conversation_id, new.timestamp")
+    triggers = [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS interactions_fts_insert AFTER INSERT ON interactions
+        WHEN new.message_type IN ('prompt', 'response')
+        BEGIN
+            INSERT INTO interactions_fts ({columns}) VALUES ({values});
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS interactions_fts_delete AFTER DELETE ON interactions
+        BEGIN
+            DELETE FROM interactions_fts WHERE rowid = old.id;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS interactions_fts_update AFTER UPDATE ON interactions
+        BEGIN
+            DELETE FROM interactions_fts WHERE rowid = old.id;
+            INSERT INTO interactions_fts ({columns})
+            SELECT {values} WHERE new.message_type IN ('prompt', 'response');
+        END
+        '''
+    ]
+    for trigger_sql in triggers:
+        _execute_sql(conn, trigger_sql)
+
+    if not exists:
+        _execute_sql(conn, f'''
+            INSERT INTO interactions_fts ({columns})
+            SELECT i.id, {_FTS_CONTENT_SQL.format(row='i')}, {_FTS_REASONING_SQL.format(row='i')},
+                   'u' || i.user_id, i.conversation_id, i.timestamp
+            FROM interactions i
+            WHERE i.message_type IN ('prompt', 'response')
+        ''')
+
+def _table_exists(conn, table):
+    cursor = _execute_sql(conn, "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return cursor.fetchone() is not None
+
+def has_table(user_id, table):
+    """Есть ли таблица table в файле БД пользователя"""
+    with sqlite3.connect(get_db_path(user_id)) as conn:
+        return _table_exists(conn, table)
+
+def ensure_db(user_id):
+    """Инициализация файла БД пользователя, если в нем еще нет таблиц"""
+    if not has_table(user_id, 'user_settings'):
+        init_db(user_id)
+
+def authorize_user(user_id, model_name):
+    """Авторизация пользователя с назначением модели по умолчанию"""
+    ensure_db(user_id)
+    with sqlite3.connect(get_db_path(user_id)) as conn:
+        try:
+            _execute_sql(conn, '''
+                INSERT OR REPLACE INTO user_settings (user_id, is_authorized, model_name)
+                VALUES (?, 1, ?)
+            ''', (user_id, model_name))
+        except sqlite3.Error as e:
+            logging.error("Error authorizing user: %s", e)
+            raise
+
+def is_user_authorized(user_id):
+    """Проверка флага авторизации пользователя"""
+    ensure_db(user_id)
+    with sqlite3.connect(get_db_path(user_id)) as conn:
+        try:
+            cursor = _execute_sql(conn,
+                'SELECT is_authorized FROM user_settings WHERE user_id = ?', (user_id,))
+            result = cursor.fetchone()
+            return bool(result and result[0])
+        except sqlite3.Error as e:
+            logging.error("Error checking authorization: %s", e)
+            raise
+
+def get_current_conversation_id(user_id):
+    """
+    ID диалога, к которому относится последняя запись пользователя
+
+    Returns:
+        str или None, если записей еще нет
+    """
+    with sqlite3.connect(get_db_path(user_id)) as conn:
+        cursor = _execute_sql(conn, "PRAGMA table_info(interactions)")
+        columns = {col[1] for col in cursor.fetchall()}
+        if not {'user_id', 'conversation_id', 'timestamp'}.issubset(columns):
+            return None
+        cursor = _execute_sql(conn, '''
+            SELECT conversation_id FROM interactions
+            WHERE user_id = ?
+            ORDER BY timestamp DESC
+            LIMIT 1
+        ''', (user_id,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+def clear_context(user_id):
+    """Очистка контекста пользователя (вместе с сохраненными окнами контекста)"""
+    with sqlite3.connect(get_db_path(user_id)) as conn:
+        try:
+            _execute_sql(conn, "DELETE FROM conversation_context WHERE user_id = ?", (user_id,))
+            _execute_sql(conn, "DELETE FROM context_windows WHERE user_id = ?", (user_id,))
+        except sqlite3.Error as e:
+            logging.error("Error clearing context: %s", e)
             raise
 
 def get_user_model(user_id):
     """Получение модели пользователя с обработкой ошибок"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with sqlite3.connect(get_db_path(user_id)) as conn:
         try:
             cursor = _execute_sql(conn, 
                 "SELECT name FROM sqlite_master WHERE type='table' AND name='user_settings'")
@@ -97,15 +321,15 @@ def get_user_model(user_id):
             result = cursor.fetchone()
             return result[0] if result else 'deepseek-chat'
         except sqlite3.Error as e:
-            logging.error(f"Error getting user model: {e}")
+            logging.error("Error getting user model: %s", e)
             return 'deepseek-chat'
 
 def set_user_model(user_id, model_name):
     """Установка модели пользователя"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with sqlite3.connect(get_db_path(user_id)) as conn:
         try:
             # Инициализируем БД если нужно
-            init_db()
+            init_db(user_id)
             
             # Простая и надежная вставка/обновление
             _execute_sql(conn, '''
@@ -121,23 +345,339 @@ def set_user_model(user_id, model_name):
                 ))
             ''', (user_id, model_name, user_id, user_id))
         except sqlite3.Error as e:
-            logging.error(f"Error setting user model: {e}")
+            logging.error("Error setting user model: %s", e)
             raise
 
 def save_interaction(user_id, conversation_id, message_type, content, 
-                    tokens, cost, timestamp, model_name):
-    """Сохранение взаимодействия с пользователем"""
-    with sqlite3.connect(DB_PATH) as conn:
+                    tokens, cost, timestamp, model_name,
+                    cache_hit_tokens=0, cache_miss_tokens=0, purpose='dialog'):
+    """Сохранение взаимодействия с пользователем
+
+    Args:
+        purpose: 'dialog' — реплика диалога; 'map' и 'compare' — вспомогательные запросы
+                 (части map-reduce, ответы /compare), не входящие в контекст
+    """
+    with sqlite3.connect(get_db_path(user_id)) as conn:
         try:
             _execute_sql(conn, '''
                 INSERT INTO interactions (
                     user_id, conversation_id, message_type, content,
-                    tokens, cost, timestamp, model_name
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    tokens, cost, timestamp, model_name,
+                    cache_hit_tokens, cache_miss_tokens, purpose
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 user_id, conversation_id, message_type, content,
-                tokens, cost, timestamp, model_name
+                tokens, cost, timestamp, model_name,
+                cache_hit_tokens, cache_miss_tokens, purpose
             ))
         except sqlite3.Error as e:
-            logging.error(f"Error saving interaction: {e}")
+            logging.error("Error saving interaction: %s", e)
+            raise
+
+def get_context_page(user_id, conversation_id, after_id=None, before_id=None, limit=6):
+    """
+    Keyset-пагинация контекста диалога по (conversation_id, id)
+
+    Args:
+        user_id: ID пользователя
+        conversation_id: ID диалога
+        after_id: Вернуть записи с id больше указанного (следующая страница)
+        before_id: Вернуть записи с id меньше указанного (предыдущая страница)
+        limit: Размер страницы
+
+    Returns:
+        tuple: (rows, has_prev, has_next), где rows — список (id, role, content, timestamp)
+    """
+    with sqlite3.connect(get_db_path(user_id)) as conn:
+        try:
+            if before_id is not None:
+                cursor = _execute_sql(conn, '''
+                    SELECT id, role, content, timestamp FROM conversation_context
+                    WHERE user_id = ? AND conversation_id = ? AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                ''', (user_id, conversation_id, before_id, limit + 1))
+                rows = cursor.fetchall()
+                has_prev = len(rows) > limit
+                rows = list(reversed(rows[:limit]))
+                # Запись before_id существует, значит следующая страница тоже есть
+                has_next = True
+            else:
+                cursor = _execute_sql(conn, '''
+                    SELECT id, role, content, timestamp FROM conversation_context
+                    WHERE user_id = ? AND conversation_id = ? AND id > ?
+                    ORDER BY id ASC
+                    LIMIT ?
+                ''', (user_id, conversation_id, after_id or 0, limit + 1))
+                rows = cursor.fetchall()
+                has_next = len(rows) > limit
+                rows = rows[:limit]
+                has_prev = after_id is not None
+
+            return rows, has_prev, has_next
+        except sqlite3.Error as e:
+            logging.error("Error getting context page: %s", e)
+            raise
+
+def iter_context(user_id, conversation_id, batch_size=500):
+    """
+    Генератор записей контекста диалога, читающий БД пачками по id
+
+    Соединение не удерживается между пачками, поэтому генератор можно
+    безопасно потреблять из асинхронного кода по частям.
+
+    Yields:
+        tuple: (id, role, content, timestamp)
+    """
+    last_id = 0
+    while True:
+        with sqlite3.connect(get_db_path(user_id)) as conn:
+            cursor = _execute_sql(conn, '''
+                SELECT id, role, content, timestamp FROM conversation_context
+                WHERE user_id = ? AND conversation_id = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (user_id, conversation_id, last_id, batch_size))
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1][0]
+
+def iter_interactions(user_id, batch_size=500):
+    """
+    Генератор всей истории взаимодействий пользователя, читающий БД пачками по id
+
+    Yields:
+        dict: Запись из таблицы interactions
+    """
+    last_id = 0
+    while True:
+        with sqlite3.connect(get_db_path(user_id)) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = _execute_sql(conn, '''
+                SELECT id, conversation_id, message_type, content,
+                       tokens, cost, timestamp, model_name,
+                       cache_hit_tokens, cache_miss_tokens, purpose
+                FROM interactions
+                WHERE user_id = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (user_id, last_id, batch_size))
+            rows = [dict(row) for row in cursor.fetchall()]
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1]["id"]
+
+def _context_tokens(role, content):
+    """Размер сообщения контекста в токенах"""
+    return num_tokens_from_messages([{"role": role, "content": content}])
+
+def save_context(user_id, conversation_id, role, content, timestamp):
+    """Сохранение сообщения в контекст диалога вместе с его размером в токенах"""
+    with sqlite3.connect(get_db_path(user_id)) as conn:
+        try:
+            _execute_sql(conn, '''
+                INSERT INTO conversation_context (user_id, conversation_id, role, content, timestamp, tokens)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, conversation_id, role, content, timestamp, _context_tokens(role, content)))
+        except sqlite3.Error as e:
+            logging.error("Error saving context: %s", e)
+            raise
+
+def get_context_window(user_id, conversation_id, max_tokens):
+    """
+    Окно контекста диалога не больше max_tokens токенов, в порядке сохранения.
+
+    Начало окна хранится в context_windows, поэтому читаются только записи окна,
+    а размеры берутся из колонки tokens без повторной токенизации. Новые ходы
+    дописываются в конец, и префикс запроса не меняется между ходами. При
+    переполнении начало переносится вперед по вопросам пользователя так, чтобы
+    осталась половина бюджета, и до следующего переполнения снова не меняется.
+
+    Returns:
+        list: Сообщения в формате {"role": "...", "content": "..."}
+    """
+    with sqlite3.connect(get_db_path(user_id)) as conn:
+        try:
+            row = conn.execute('''
+                SELECT start_id FROM context_windows WHERE user_id = ? AND conversation_id = ?
+            ''', (user_id, conversation_id)).fetchone()
+            start_id = row[0] if row else 0
+            rows = conn.execute('''
+                SELECT id, role, content, tokens FROM conversation_context
+                WHERE user_id = ? AND conversation_id = ? AND id >= ?
+                ORDER BY id ASC
+            ''', (user_id, conversation_id, start_id)).fetchall()
+
+            # Записи, сохраненные до появления колонки tokens, считаются один раз
+            missing = [(_context_tokens(role, content), row_id)
+                       for row_id, role, content, tokens in rows if tokens is None]
+            if missing:
+                conn.executemany("UPDATE conversation_context SET tokens = ? WHERE id = ?", missing)
+                sizes = {row_id: tokens for tokens, row_id in missing}
+                rows = [(row_id, role, content, sizes.get(row_id, tokens))
+                        for row_id, role, content, tokens in rows]
+
+            start = 0
+            window_tokens = sum(row[3] for row in rows)
+            if window_tokens > max_tokens:
+                # Окно начинается только с вопроса пользователя, чтобы не оставлять ответ без вопроса
+                user_rows = [i for i, row in enumerate(rows) if row[1] == 'user']
+                for index in user_rows:
+                    if index == start:
+                        continue
+                    if window_tokens <= max_tokens // 2:
+                        break
+                    window_tokens -= sum(row[3] for row in rows[start:index])
+                    start = index
+                if rows and rows[start][0] != start_id:
+                    conn.execute('''
+                        INSERT OR REPLACE INTO context_windows (user_id, conversation_id, start_id)
+                        VALUES (?, ?, ?)
+                    ''', (user_id, conversation_id, rows[start][0]))
+            conn.commit()
+            return [{"role": role, "content": content} for _, role, content, _ in rows[start:]]
+        except sqlite3.Error as e:
+            logging.error("Error loading context window: %s", e)
+            raise
+
+def get_usage_stats(user_id=None):
+    """
+    Статистика расхода по моделям: токены, стоимость и доля попаданий в кэш префикса
+
+    Args:
+        user_id: ID пользователя; None — по всем пользователям с разбивкой по user_id
+
+    Returns:
+        list: Словари с ключами user_id, model_name, requests, prompt_tokens,
+              completion_tokens, cache_hit_tokens, cache_miss_tokens, cost, cache_hit_ratio
+    """
+    where = "WHERE model_name != 'system'"
+    params = ()
+    if user_id is not None:
+        where += " AND user_id = ?"
+        params = (user_id,)
+
+    def query(path):
+        with sqlite3.connect(path) as conn:
+            try:
+                conn.row_factory = sqlite3.Row
+                cursor = _execute_sql(conn, f'''
+                    SELECT user_id, model_name,
+                           SUM(message_type = 'prompt') AS requests,
+                           SUM(CASE WHEN message_type = 'prompt' THEN tokens ELSE 0 END) AS prompt_tokens,
+                           SUM(CASE WHEN message_type = 'response' THEN tokens ELSE 0 END) AS completion_tokens,
+                           SUM(cache_hit_tokens) AS cache_hit_tokens,
+                           SUM(cache_miss_tokens) AS cache_miss_tokens,
+                           SUM(cost) AS cost
+                    FROM interactions
+                    {where}
+                    GROUP BY user_id, model_name
+                ''', params)
+                return [dict(row) for row in cursor.fetchall()]
+            except sqlite3.Error as e:
+                logging.error("Error getting usage stats: %s", e)
+                raise
+
+    # Отчет по всем пользователям собирается параллельными запросами ко всем шардам
+    paths = [get_db_path(user_id)] if user_id is not None else None
+    stats = sorted(_fan_out(query, paths), key=lambda row: (row["user_id"], row["model_name"]))
+
+    for row in stats:
+        cached = row["cache_hit_tokens"] + row["cache_miss_tokens"]
+        row["cache_hit_ratio"] = row["cache_hit_tokens"] / cached if cached else 0.0
+    return stats
+
+def _fts_query(query):
+    """Преобразует пользовательский запрос в выражение FTS5: все слова, с поиском по префиксу"""
+    terms = [term.replace('"', '""') for term in query.split()]
+    return " ".join(f'"{term}"*' for term in terms if term)
+
+def search_interactions(user_id, query, limit=5):
+    """
+    Полнотекстовый поиск по истории пользователя с ранжированием bm25
+
+    Args:
+        user_id: ID пользователя
+        query: Текст запроса
+        limit: Максимальное количество результатов
+
+    Returns:
+        list: Словари с ключами id, conversation_id, timestamp, message_type, snippet
+    """
+    match = _fts_query(query)
+    if not match:
+        return []
+
+    with sqlite3.connect(get_db_path(user_id)) as conn:
+        try:
+            conn.row_factory = sqlite3.Row
+            cursor = _execute_sql(conn, '''
+                SELECT f.rowid AS id, f.conversation_id, f.timestamp, i.message_type,
+                       snippet(interactions_fts, -1, '«', '»', '…', 16) AS snippet
+                FROM interactions_fts f
+                JOIN interactions i ON i.id = f.rowid
+                WHERE interactions_fts MATCH ?
+                ORDER BY bm25(interactions_fts, 1.0, 0.5, 0.0)
+                LIMIT ?
+            ''', (f"owner:u{int(user_id)} AND {{content reasoning}}: ({match})", limit))
+            return [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logging.error("Error searching interactions: %s", e)
+            raise
+
+def restore_conversation(user_id, conversation_id, timestamp):
+    """
+    Делает найденный диалог активным: контекст пользователя заменяется парами
+    промпт/ответ этого диалога из interactions, а системная запись с его
+    conversation_id делает его текущим. Вспомогательные запросы (части map-reduce,
+    ответы /compare) в контекст не попадали и не восстанавливаются
+
+    Returns:
+        int: Количество восстановленных сообщений контекста
+    """
+    with sqlite3.connect(get_db_path(user_id)) as conn:
+        try:
+            cursor = _execute_sql(conn, '''
+                SELECT message_type, content, timestamp FROM interactions
+                WHERE user_id = ? AND conversation_id = ? AND message_type IN ('prompt', 'response')
+                  AND purpose = 'dialog'
+                ORDER BY id ASC
+            ''', (user_id, conversation_id))
+
+            # Берем только пары "промпт -> ответ", ответ reasoner — без рассуждений
+            context = []
+            prompt = None
+            for message_type, content, created_at in cursor.fetchall():
+                if message_type == 'prompt':
+                    prompt = (content, created_at)
+                elif prompt is not None:
+                    if content.startswith('{"reasoning"'):
+                        try:
+                            content = json.loads(content)["answer"]
+                        except (ValueError, KeyError):
+                            pass
+                    context.append(('user',) + prompt)
+                    context.append(('assistant', content, created_at))
+                    prompt = None
+
+            conn.execute("DELETE FROM conversation_context WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM context_windows WHERE user_id = ?", (user_id,))
+            conn.executemany('''
+                INSERT INTO conversation_context (user_id, conversation_id, role, content, timestamp, tokens)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(user_id, conversation_id, role, content, created_at, _context_tokens(role, content))
+                  for role, content, created_at in context])
+            conn.execute('''
+                INSERT INTO interactions (
+                    user_id, conversation_id, message_type, content,
+                    tokens, cost, timestamp, model_name
+                ) VALUES (?, ?, 'system', 'restore_conversation', 0, 0, ?, 'system')
+            ''', (user_id, conversation_id, timestamp))
+            conn.commit()
+            return len(context)
+        except sqlite3.Error as e:
+            logging.error("Error restoring conversation: %s", e)
             raise
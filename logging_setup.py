@@ -0,0 +1,166 @@
+# logging_setup.py
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from contextvars import ContextVar
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Размер очереди логов; при переполнении записи отбрасываются, а не блокируют цикл событий
+LOG_QUEUE_SIZE = 10000
+
+# Сэмплирование по уровням: (сколько записей пропускать, за сколько секунд).
+# Лимит считается отдельно для каждого места вызова (файл:строка).
+# Уровни, которых нет в словаре, не сэмплируются.
+LOG_SAMPLING = {
+    logging.DEBUG: (10, 1.0),
+    logging.INFO: (20, 1.0),
+    logging.WARNING: (20, 1.0),
+    logging.ERROR: (10, 1.0)
+}
+
+# Контекст текущего апдейта Telegram, добавляется в каждую запись лога
+request_id_var: ContextVar = ContextVar("request_id", default=None)
+user_id_var: ContextVar = ContextVar("user_id", default=None)
+conversation_id_var: ContextVar = ContextVar("conversation_id", default=None)
+model_var: ContextVar = ContextVar("model", default=None)
+
+_CONTEXT_VARS = {
+    "request_id": request_id_var,
+    "user_id": user_id_var,
+    "conversation_id": conversation_id_var,
+    "model": model_var
+}
+
+
+def bind_log_context(**values):
+    """
+    Устанавливает поля контекста логов для текущей задачи asyncio
+
+    Args:
+        **values: request_id, user_id, conversation_id и/или model
+    """
+    for key, value in values.items():
+        _CONTEXT_VARS[key].set(value)
+
+
+class ContextFilter(logging.Filter):
+    """Копирует контекст апдейта в запись. Работает в потоке, где вызван логгер"""
+
+    def filter(self, record):
+        for key, var in _CONTEXT_VARS.items():
+            if not hasattr(record, key):
+                setattr(record, key, var.get())
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Ограничивает частоту одинаковых событий: не больше burst записей за interval секунд
+    на каждое место вызова. Количество отброшенных записей добавляется в следующую
+    пропущенную запись как поле suppressed.
+    """
+
+    def __init__(self, sampling=None):
+        super().__init__()
+        self.sampling = LOG_SAMPLING if sampling is None else sampling
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        limits = self.sampling.get(record.levelno)
+        if limits is None:
+            return True
+
+        burst, interval = limits
+        key = (record.pathname, record.lineno, record.levelno)
+        now = time.monotonic()
+        with self._lock:
+            window_start, count, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - window_start >= interval:
+                window_start, count = now, 0
+            if count >= burst:
+                self._windows[key] = (window_start, count, suppressed + 1)
+                return False
+            self._windows[key] = (window_start, count + 1, 0)
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись вместо ожидания"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Сообщение собирается здесь, а исключение форматируется уже в потоке слушателя
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for key in _CONTEXT_VARS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level=LOG_LEVEL):
+    """
+    Неблокирующее логирование: обработчики корневого логгера только кладут записи
+    в очередь, а форматирование в JSON и запись в поток выполняет отдельный поток
+    QueueListener.
+
+    Returns:
+        logging.handlers.QueueListener: Запущенный слушатель очереди
+    """
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    queue_handler.addFilter(ContextFilter())
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -4,13 +4,17 @@ import asyncio
 import uuid
 import json
 import sqlite3
-from typing import Dict, Optional
+import codecs
+import os
+import signal
+from datetime import datetime
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Iterable, List, Optional, Set
 
-from aiogram import Bot, Dispatcher, types, Router, F
-from aiogram.types import Message
+from aiogram import Bot, BaseMiddleware, Dispatcher, types, Router, F
+from aiogram.types import TelegramObject, Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputFile
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.filters import Command
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 
 from openai import AsyncOpenAI
 from config import (
@@ -18,19 +22,103 @@ from config import (
     OPENAI_API_KEY,
     SECRET_KEYWORD,
     OPENAI_BASE_URL,
-    OPENAI_MODEL
+    OPENAI_MODEL,
+    ADMIN_USER_IDS
+)
+from database import (
+    init_db,
+    save_interaction,
+    get_user_model,
+    set_user_model,
+    get_context_page,
+    iter_context,
+    iter_interactions,
+    save_context,
+    get_context_window,
+    get_usage_stats,
+    search_interactions,
+    restore_conversation,
+    ensure_db,
+    has_table,
+    authorize_user,
+    is_user_authorized,
+    get_current_conversation_id,
+    clear_context,
+    DB_FOLDER
+)
+from logging_setup import setup_logging, bind_log_context
+from profiling import SamplingProfiler
+from utils import (
+    num_tokens_from_messages,
+    calculate_cost,
+    calculate_prompt_cost,
+    parse_usage,
+    split_text_by_tokens,
+    asplit_text_by_tokens,
+    choose_model,
+    AUTO_MODEL
 )
-from database import init_db, save_interaction, get_user_model, set_user_model, DB_PATH
-from utils import num_tokens_from_messages, calculate_cost
 
 # Глобальные словари для управления состоянием
 active_requests: Dict[int, float] = {}  # Таймстампы активных запросов
 authorized_users: Dict[int, bool] = {}  # Кэш авторизованных пользователей
+pending_messages: Dict[int, List[Message]] = {}  # Буфер сообщений, ожидающих склейки
+pending_flush_tasks: Dict[int, asyncio.Task] = {}  # Отложенная отправка буфера
+background_tasks: Set[asyncio.Task] = set()  # Сильные ссылки на фоновые задачи до их завершения
 
 # Таймаут запроса в секундах (5 минут)
 REQUEST_TIMEOUT = 300
 # Время жизни кэша авторизации в секундах (1 час)
 AUTH_CACHE_TTL = 3600
+# Количество записей контекста на одной странице /context
+CONTEXT_PAGE_SIZE = 6
+# Максимальная длина одной записи на странице /context (полный текст — через /export)
+CONTEXT_ENTRY_PREVIEW = 600
+# Длительность профилирования по умолчанию (/profile без аргументов и SIGUSR1), в секундах
+PROFILE_DEFAULT_SECONDS = 30
+# Окно ожидания продолжения (Telegram режет длинный текст на несколько сообщений), в секундах
+MESSAGE_DEBOUNCE_DELAY = 1.5
+# Промпт длиннее этого порога (в токенах) обрабатывается по частям (map-reduce)
+MAX_PROMPT_TOKENS = 48000
+# Бюджет истории диалога в запросе, в токенах. При переполнении окно сдвигается
+# сразу до половины бюджета, чтобы следующие ходы снова шли с тем же префиксом
+HISTORY_MAX_TOKENS = 12000
+# Размер одной части при map-reduce, в токенах
+CHUNK_TOKENS = 6000
+# Максимум одновременных запросов к API при map-reduce
+MAP_REDUCE_CONCURRENCY = 4
+# Максимум раундов map: если результаты частей не помещаются в контекст и после них, запрос прерывается
+MAP_REDUCE_MAX_ROUNDS = 3
+# Максимальный размер загружаемого документа (ограничение Bot API — 20 МБ)
+MAX_DOCUMENT_SIZE = 20 * 1024 * 1024
+# Расширения файлов, которые принимаются как текст
+TEXT_DOCUMENT_EXTENSIONS = {
+    ".txt", ".md", ".markdown", ".rst", ".csv", ".tsv", ".json", ".jsonl", ".yaml", ".yml",
+    ".toml", ".ini", ".cfg", ".xml", ".html", ".css", ".log", ".sql", ".sh", ".py", ".js",
+    ".ts", ".tsx", ".jsx", ".java", ".kt", ".go", ".rs", ".c", ".h", ".cpp", ".hpp", ".cs",
+    ".php", ".rb", ".swift", ".nix"
+}
+# Шаблоны запросов для map-reduce
+MAP_PROMPT = (
+    "Задание: {instruction}\n\n"
+    "Ниже фрагмент {index} из {total} ({source}). Выпиши из него все, что нужно "
+    "для выполнения задания, кратко и без потери фактов.\n\n{chunk}"
+)
+REDUCE_PROMPT = (
+    "Задание: {instruction}\n\n"
+    "Ниже по порядку результаты обработки всех {total} фрагментов ({source}). "
+    "Выполни задание, опираясь на них.\n\n{partials}"
+)
+SINGLE_CHUNK_PROMPT = "Задание: {instruction}\n\n{source}:\n\n{chunk}"
+# Задания по умолчанию для файлов без подписи и для слишком длинных сообщений
+DOCUMENT_INSTRUCTION = "кратко изложи содержание файла"
+# Максимальное количество результатов /search
+SEARCH_RESULTS_LIMIT = 5
+# Модели, которые сравниваются в /compare
+COMPARE_MODELS = ("deepseek-chat", "deepseek-reasoner")
+# Минимальный интервал между обновлениями живого ответа (обычный запрос и /compare), в секундах
+STREAM_EDIT_INTERVAL = 1.5
+LONG_PROMPT_INSTRUCTION = "ответь на сообщение пользователя (вопрос или просьба могут быть в любом фрагменте)"
 
 # Настройка клиента OpenAI
 client = AsyncOpenAI(
@@ -38,11 +126,8 @@ client = AsyncOpenAI(
     base_url=OPENAI_BASE_URL
 )
 
-# Настройка логгера
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Настройка логгера: JSON-записи с контекстом апдейта, запись в поток — в отдельном потоке
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Инициализация бота и диспетчера
@@ -50,6 +135,30 @@ bot = Bot(token=TELEGRAM_BOT_TOKEN)
 dp = Dispatcher(storage=MemoryStorage())
 router = Router()
 
+class LogContextMiddleware(BaseMiddleware):
+    """Привязывает к логам каждого апдейта свой request_id и user_id"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        bind_log_context(
+            request_id=uuid.uuid4().hex[:12],
+            user_id=user.id if user else None,
+            conversation_id=None,
+            model=None
+        )
+        return await handler(event, data)
+
+dp.update.outer_middleware(LogContextMiddleware())
+
+# Профилирование по запросу администратора; выключено, пока не запущено /profile или SIGUSR1
+profiler = SamplingProfiler(DB_FOLDER)
+
+
 async def send_long_message(message: Message, text: str, max_length: int = 4096, edit_message=None) -> None:
     """
     Отправляет длинное сообщение частями или редактирует существующее сообщение
@@ -68,7 +177,7 @@ async def send_long_message(message: Message, text: str, max_length: int = 4096,
             else:
                 await message.reply(part)
         except TelegramBadRequest as e:
-            logger.error(f"Failed to send message part: {e}")
+            logger.error("Failed to send message part: %s", e)
 
 @router.message(Command("test_long_message"))
 async def test_long_message(message: Message) -> None:
@@ -96,7 +205,7 @@ async def test_long_message(message: Message) -> None:
             # Для обычной модели просто отправляем длинный текст
             await send_long_message(message, long_text)
     except Exception as e:
-        logger.error(f"Error in test_long_message for user {user_id}: {e}")
+        logger.error("Error in test_long_message for user %s: %s", user_id, e)
         await message.reply("⚠️ Произошла ошибка при обработке тестового сообщения")
 
 @router.message(Command("auth"))
@@ -119,19 +228,8 @@ async def auth_user(message: Message) -> None:
         return
     
     try:
-        # Проверяем существование таблиц
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_settings'")
-            if not cursor.fetchone():
-                init_db()
-            
-            # Обновляем статус авторизации в user_settings
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_settings (user_id, is_authorized, model_name)
-                VALUES (?, 1, 'deepseek-chat')
-            ''', (user_id,))
-            conn.commit()
+        # Обновляем статус авторизации в user_settings
+        authorize_user(user_id, OPENAI_MODEL)
 
         # Сохраняем запрос авторизации
         save_interaction(
@@ -151,12 +249,15 @@ async def auth_user(message: Message) -> None:
         authorized_users[user_id] = True
         await message.reply("✅ Авторизация успешна! Теперь вы можете использовать бота.")
     except Exception as e:
-        logger.error(f"Error authorizing user {user_id}: {e}")
+        logger.error("Error authorizing user %s: %s", user_id, e)
         await message.reply("⚠️ Ошибка авторизации. Попробуйте снова или перезапустите бота.")
 
 @router.message(Command("model"))
 async def handle_model_command(message: Message):
-    await message.reply("Используйте /model_chat или /model_reasoner для выбора модели")
+    await message.reply(
+        "Используйте /model_chat, /model_reasoner или /model_auto "
+        "(автоматический выбор модели под каждый запрос)"
+    )
 
 @router.message(Command("model_chat"))
 async def set_model_chat(message: Message) -> None:
@@ -176,11 +277,7 @@ async def set_model_chat(message: Message) -> None:
             return
             
         # Проверяем существование таблиц
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='interactions'")
-            if not cursor.fetchone():
-                init_db()
+        ensure_db(user_id)
             
         # Обновляем модель пользователя
         set_user_model(user_id, "deepseek-chat")
@@ -198,14 +295,11 @@ async def set_model_chat(message: Message) -> None:
         )
         
         # Очищаем контекст
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM conversation_context WHERE user_id = ?", (user_id,))
-            conn.commit()
+        clear_context(user_id)
         
         await message.answer("✅ Модель изменена на deepseek-chat\nКонтекст очищен")
     except Exception as e:
-        logger.error(f"Error setting model_chat for user {user_id}: {str(e)}")
+        logger.error("Error setting model_chat for user %s: %s", user_id, e)
         error_details = f"Ошибка: {str(e)}" if str(e) else "Неизвестная ошибка"
         await message.answer(
             f"⚠️ Ошибка при изменении модели\n"
@@ -224,7 +318,7 @@ async def new_conversation(message: Message) -> None:
     
     try:
         # Проверяем и инициализируем БД перед выполнением
-        init_db()
+        init_db(user_id)
             
         # Сохраняем информацию о новом диалоге
         save_interaction(
@@ -239,19 +333,50 @@ async def new_conversation(message: Message) -> None:
         )
         
         # Очищаем контекст
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM conversation_context WHERE user_id = ?", (user_id,))
-            conn.commit()
+        clear_context(user_id)
         
         await message.reply("✅ Новый диалог начат. Предыдущий контекст полностью очищен.")
     except Exception as e:
-        logger.error(f"Error starting new conversation for user {user_id}: {e}")
+        logger.error("Error starting new conversation for user %s: %s", user_id, e)
         await message.reply("⚠️ Ошибка при очистке контекста")
 
+def _render_context_page(rows) -> str:
+    """
+    Формирует текст страницы контекста, укладывающийся в одно сообщение Telegram
+
+    Args:
+        rows: Список записей (id, role, content, timestamp)
+    """
+    context = []
+    for _, role, content, _ in rows:
+        prefix = "👤 Вы: " if role == 'user' else "🤖 Бот: "
+        if len(content) > CONTEXT_ENTRY_PREVIEW:
+            content = content[:CONTEXT_ENTRY_PREVIEW] + "…"
+        context.append(f"{prefix}{content}")
+    return "\n\n".join(context)
+
+def _context_keyboard(conversation_id: str, rows, has_prev: bool, has_next: bool) -> Optional[InlineKeyboardMarkup]:
+    """
+    Кнопки навигации по контексту. В callback_data передается граница страницы (keyset)
+
+    Args:
+        conversation_id: ID диалога
+        rows: Записи текущей страницы
+        has_prev: Есть ли предыдущая страница
+        has_next: Есть ли следующая страница
+    """
+    buttons = []
+    if rows and has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"ctx:prev:{conversation_id}:{rows[0][0]}"))
+    if rows and has_next:
+        buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"ctx:next:{conversation_id}:{rows[-1][0]}"))
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
 @router.message(Command("context"))
 async def show_context(message: Message) -> None:
-    """Показать текущий контекст диалога
+    """Показать текущий контекст диалога постранично
     
     Args:
         message: Входящее сообщение с командой
@@ -266,12 +391,9 @@ async def show_context(message: Message) -> None:
             return
 
         # Проверяем существование таблиц
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='conversation_context'")
-            if not cursor.fetchone():
-                await message.reply("Контекст пуст.")
-                return
+        if not has_table(user_id, 'conversation_context'):
+            await message.reply("Контекст пуст.")
+            return
 
         # Получаем текущий conversation_id
         conversation_id = await _get_conversation_id(user_id)
@@ -288,28 +410,366 @@ async def show_context(message: Message) -> None:
             model_name='system'
         )
 
-        # Получаем контекст из БД
-        context = []
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT role, content FROM conversation_context
-                WHERE user_id = ? AND conversation_id = ?
-                ORDER BY timestamp
-            ''', (user_id, conversation_id))
-            
-            for role, content in cursor.fetchall():
-                prefix = "👤 Вы: " if role == 'user' else "🤖 Бот: "
-                context.append(f"{prefix}{content}")
+        # Получаем первую страницу контекста из БД
+        rows, has_prev, has_next = get_context_page(user_id, conversation_id, limit=CONTEXT_PAGE_SIZE)
 
-        if context:
-            await send_long_message(message, "\n\n".join(context))
+        if rows:
+            await message.reply(
+                _render_context_page(rows),
+                reply_markup=_context_keyboard(conversation_id, rows, has_prev, has_next)
+            )
         else:
             await message.reply("Контекст пуст.")
     except Exception as e:
-        logger.error(f"Error showing context for user {user_id}: {e}")
+        logger.error("Error showing context for user %s: %s", user_id, e)
         await message.reply("⚠️ Ошибка при получении контекста")
 
+@router.callback_query(F.data.startswith("ctx:"))
+async def paginate_context(callback: CallbackQuery) -> None:
+    """Переключение страниц контекста по кнопкам навигации
+    
+    Args:
+        callback: Callback от inline-кнопки вида ctx:<next|prev>:<conversation_id>:<id>
+    """
+    user_id = callback.from_user.id
+    
+    try:
+        _, direction, conversation_id, boundary_id = callback.data.split(":")
+        boundary_id = int(boundary_id)
+        if direction == "next":
+            rows, has_prev, has_next = get_context_page(
+                user_id, conversation_id, after_id=boundary_id, limit=CONTEXT_PAGE_SIZE)
+        else:
+            rows, has_prev, has_next = get_context_page(
+                user_id, conversation_id, before_id=boundary_id, limit=CONTEXT_PAGE_SIZE)
+
+        if not rows:
+            await callback.answer("Больше записей нет")
+            return
+
+        await callback.message.edit_text(
+            _render_context_page(rows),
+            reply_markup=_context_keyboard(conversation_id, rows, has_prev, has_next)
+        )
+        await callback.answer()
+    except TelegramBadRequest as e:
+        logger.error("Failed to edit context page for user %s: %s", user_id, e)
+        await callback.answer()
+    except Exception as e:
+        logger.error("Error paginating context for user %s: %s", user_id, e)
+        await callback.answer("⚠️ Ошибка при получении контекста")
+
+class IterableInputFile(InputFile):
+    """
+    Файл для отправки в Telegram, содержимое которого формируется генератором строк.
+    Данные кодируются и отдаются частями, полный текст в памяти не собирается.
+    """
+
+    def __init__(self, lines_factory: Callable[[], Iterable[str]], filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.lines_factory = lines_factory
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        buffer = bytearray()
+        for line in self.lines_factory():
+            buffer += line.encode("utf-8")
+            if len(buffer) >= self.chunk_size:
+                yield bytes(buffer)
+                buffer.clear()
+                # Отдаем управление циклу событий между пачками
+                await asyncio.sleep(0)
+        if buffer:
+            yield bytes(buffer)
+
+def _export_context_lines(user_id: int, conversation_id: str) -> Iterable[str]:
+    """Построчный текст текущего диалога для /export"""
+    for _, role, content, timestamp in iter_context(user_id, conversation_id):
+        prefix = "👤 Вы" if role == 'user' else "🤖 Бот"
+        date = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+        yield f"[{date}] {prefix}:\n{content}\n\n"
+
+def _export_history_lines(user_id: int) -> Iterable[str]:
+    """Вся история взаимодействий пользователя в формате JSONL для /export all"""
+    for row in iter_interactions(user_id):
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+@router.message(Command("export"))
+async def export_history(message: Message) -> None:
+    """Выгрузка текущего диалога (/export) или всей истории (/export all) файлом
+    
+    Args:
+        message: Входящее сообщение с командой
+    """
+    user_id = message.from_user.id
+    args = message.text.split()
+    export_all = len(args) > 1 and args[1].lower() == "all"
+    
+    try:
+        # Проверяем авторизацию
+        model = get_user_model(user_id)
+        if model == "system":  # Неавторизованный пользователь
+            await message.reply("❌ Доступ запрещен. Используйте /auth <ключ> для авторизации.")
+            return
+
+        init_db(user_id)
+        conversation_id = await _get_conversation_id(user_id)
+        
+        save_interaction(
+            user_id=user_id,
+            conversation_id=conversation_id,
+            message_type='system',
+            content='export_all_request' if export_all else 'export_context_request',
+            tokens=0,
+            cost=0,
+            timestamp=time.time(),
+            model_name='system'
+        )
+
+        if export_all:
+            document = IterableInputFile(
+                lambda: _export_history_lines(user_id),
+                filename=f"history_{user_id}.jsonl"
+            )
+        else:
+            if not get_context_page(user_id, conversation_id, limit=1)[0]:
+                await message.reply("Контекст пуст.")
+                return
+            document = IterableInputFile(
+                lambda: _export_context_lines(user_id, conversation_id),
+                filename=f"context_{conversation_id}.txt"
+            )
+
+        await message.reply_document(document)
+    except Exception as e:
+        logger.error("Error exporting history for user %s: %s", user_id, e)
+        await message.reply("⚠️ Ошибка при выгрузке истории")
+
+def _render_usage_stats(stats: list) -> str:
+    """Текст отчета о расходе: токены, доля попаданий в кэш префикса и стоимость по моделям"""
+    lines = []
+    for row in stats:
+        lines.append(
+            f"🔹 {row['model_name']}\n"
+            f"Запросов: {row['requests']}\n"
+            f"Токены: вход {row['prompt_tokens']} (из кэша {row['cache_hit_ratio']:.0%}), "
+            f"выход {row['completion_tokens']}\n"
+            f"Стоимость: ${row['cost']:.4f}"
+        )
+    return "\n\n".join(lines)
+
+@router.message(Command("usage"))
+async def show_usage(message: Message) -> None:
+    """Статистика расхода по моделям (/usage), для администраторов — по всем пользователям (/usage all)
+    
+    Args:
+        message: Входящее сообщение с командой
+    """
+    user_id = message.from_user.id
+    args = message.text.split()
+    show_all = len(args) > 1 and args[1].lower() == "all"
+    
+    try:
+        if show_all and user_id not in ADMIN_USER_IDS:
+            await message.reply("❌ Команда доступна только администраторам.")
+            return
+        if not show_all and not await _check_authorization(message):
+            return
+
+        # Отчет по всем пользователям опрашивает все шарды — выполняем вне цикла событий
+        stats = await asyncio.to_thread(get_usage_stats, None if show_all else user_id)
+        if not stats:
+            await message.reply("Статистика пуста.")
+            return
+
+        if show_all:
+            by_user = {}
+            for row in stats:
+                by_user.setdefault(row["user_id"], []).append(row)
+            text = "\n\n".join(
+                f"👤 {uid}\n{_render_usage_stats(rows)}" for uid, rows in by_user.items()
+            )
+        else:
+            text = _render_usage_stats(stats)
+
+        await send_long_message(message, f"📊 Расход по моделям:\n\n{text}")
+    except Exception as e:
+        logger.error("Error showing usage for user %s: %s", user_id, e)
+        await message.reply("⚠️ Ошибка при получении статистики")
+
+@router.message(Command("search"))
+async def search_history(message: Message) -> None:
+    """Полнотекстовый поиск по истории диалогов пользователя
+    
+    Args:
+        message: Входящее сообщение с командой /search <запрос>
+    """
+    user_id = message.from_user.id
+    args = message.text.split(maxsplit=1)
+    
+    if len(args) != 2 or not args[1].strip():
+        await message.reply("Используйте: /search <запрос>")
+        return
+
+    if not await _check_authorization(message):
+        return
+    
+    try:
+        results = search_interactions(user_id, args[1], limit=SEARCH_RESULTS_LIMIT)
+        if not results:
+            await message.reply("Ничего не найдено.")
+            return
+
+        lines = []
+        buttons = []
+        for i, row in enumerate(results, 1):
+            date = datetime.fromtimestamp(row["timestamp"]).strftime("%Y-%m-%d %H:%M")
+            prefix = "👤" if row["message_type"] == 'prompt' else "🤖"
+            lines.append(f"{i}. {date} {prefix} {row['snippet']}")
+            # Одна кнопка восстановления на каждый найденный диалог
+            callback_data = f"restore:{row['conversation_id']}"
+            if all(button.callback_data != callback_data for button in buttons):
+                buttons.append(InlineKeyboardButton(text=f"↩️ Диалог от {date}", callback_data=callback_data))
+
+        await message.reply(
+            "🔎 Найдено:\n\n" + "\n\n".join(lines),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[button] for button in buttons])
+        )
+    except Exception as e:
+        logger.error("Error searching history for user %s: %s", user_id, e)
+        await message.reply("⚠️ Ошибка при поиске")
+
+@router.callback_query(F.data.startswith("restore:"))
+async def restore_context(callback: CallbackQuery) -> None:
+    """Восстановление найденного диалога в качестве текущего контекста
+    
+    Args:
+        callback: Callback от inline-кнопки вида restore:<conversation_id>
+    """
+    user_id = callback.from_user.id
+    conversation_id = callback.data.split(":", 1)[1]
+    
+    try:
+        restored = restore_conversation(user_id, conversation_id, time.time())
+        if restored:
+            await callback.message.reply(f"✅ Диалог восстановлен ({restored} сообщений в контексте)")
+        else:
+            await callback.message.reply("В этом диалоге нет сообщений для восстановления")
+        await callback.answer()
+    except Exception as e:
+        logger.error("Error restoring conversation for user %s: %s", user_id, e)
+        await callback.answer("⚠️ Ошибка при восстановлении диалога")
+
+def _start_profiling(seconds: Optional[float] = None, requests: Optional[int] = None,
+                     report_chat_id: Optional[int] = None) -> None:
+    """
+    Запуск профилирования на seconds секунд или на requests запросов
+    
+    Args:
+        seconds: Длительность профилирования
+        requests: Количество обработанных запросов, после которых профилирование остановится
+        report_chat_id: Чат, куда отправить сводку
+    """
+    loop = asyncio.get_running_loop()
+    profiler.start(loop, requests=requests, report_chat_id=report_chat_id)
+    if seconds:
+        profiler.timer = loop.call_later(seconds, lambda: _spawn_background(_finish_profiling()))
+    logger.info("Profiling started: seconds=%s, requests=%s", seconds, requests)
+
+def _spawn_background(coro: Awaitable[Any]) -> asyncio.Task:
+    """
+    Запуск фоновой задачи. Ссылка на задачу хранится в background_tasks до ее
+    завершения, иначе цикл событий держит только слабую ссылку и задачу может
+    собрать сборщик мусора
+    
+    Args:
+        coro: Корутина для запуска
+    
+    Returns:
+        asyncio.Task: Запущенная задача
+    """
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def _profile_request_finished() -> None:
+    """
+    Учет завершенной обработки запроса (ответ модели, документ, /compare) при
+    профилировании с лимитом по числу запросов. Апдейты Telegram не подходят для
+    счета: обычное сообщение только попадает в буфер, а работа идет позже
+    """
+    if profiler.active and profiler.request_finished():
+        await _finish_profiling()
+
+async def _finish_profiling() -> None:
+    """Остановка профилирования, запись отчетов и отправка сводки администратору"""
+    if not profiler.active:
+        return
+    report_chat_id = profiler.report_chat_id
+    try:
+        collapsed_path, summary_path, summary = profiler.stop()
+    except Exception as e:
+        logger.error("Failed to write profile: %s", e)
+        return
+
+    logger.info("Profiling finished: %s, %s", collapsed_path, summary_path)
+    if report_chat_id is not None:
+        try:
+            await bot.send_message(
+                report_chat_id,
+                f"📈 Профилирование завершено\n{collapsed_path}\n{summary_path}\n\n{summary[:3500]}"
+            )
+        except TelegramAPIError as e:
+            # Отчеты уже записаны на диск, в чат уходит только сводка
+            logger.error("Failed to send profile summary: %s", e)
+
+@router.message(Command("profile"))
+async def profile_command(message: Message) -> None:
+    """Профилирование живых обработчиков (только для администраторов)
+    
+    /profile — на PROFILE_DEFAULT_SECONDS секунд, /profile seconds <T>,
+    /profile requests <N>, /profile stop
+    
+    Args:
+        message: Входящее сообщение с командой
+    """
+    user_id = message.from_user.id
+    args = message.text.split()
+
+    if user_id not in ADMIN_USER_IDS:
+        await message.reply("❌ Команда доступна только администраторам.")
+        return
+
+    try:
+        if len(args) > 1 and args[1] == "stop":
+            if not profiler.active:
+                await message.reply("Профилирование не запущено.")
+                return
+            profiler.report_chat_id = message.chat.id
+            await _finish_profiling()
+            return
+
+        if profiler.active:
+            await message.reply("Профилирование уже запущено. Остановить: /profile stop")
+            return
+
+        mode, limit = "seconds", PROFILE_DEFAULT_SECONDS
+        if len(args) == 3 and args[1] in ("seconds", "requests") and args[2].isdigit() and int(args[2]) > 0:
+            mode, limit = args[1], int(args[2])
+        elif len(args) != 1:
+            await message.reply("Используйте: /profile [seconds <T> | requests <N> | stop]")
+            return
+
+        if mode == "seconds":
+            _start_profiling(seconds=limit, report_chat_id=message.chat.id)
+            await message.reply(f"📈 Профилирование запущено на {limit} с")
+        else:
+            _start_profiling(requests=limit, report_chat_id=message.chat.id)
+            await message.reply(f"📈 Профилирование запущено, запросов до остановки: {limit}")
+    except Exception as e:
+        logger.error("Error starting profiler for user %s: %s", user_id, e)
+        await message.reply("⚠️ Ошибка при запуске профилирования")
+
 @router.message(Command("model_reasoner"))
 async def set_model_reasoner(message: Message) -> None:
     """Установка модели deepseek-reasoner для пользователя
@@ -327,11 +787,7 @@ async def set_model_reasoner(message: Message) -> None:
             return
             
         # Проверяем существование таблиц
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='interactions'")
-            if not cursor.fetchone():
-                init_db()
+        ensure_db(user_id)
             
         # Обновляем модель пользователя
         set_user_model(user_id, "deepseek-reasoner")
@@ -349,10 +805,7 @@ async def set_model_reasoner(message: Message) -> None:
         )
         
         # Очищаем контекст
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM conversation_context WHERE user_id = ?", (user_id,))
-            conn.commit()
+        clear_context(user_id)
         
         await message.reply(
             "✅ Модель изменена на deepseek-reasoner\n"
@@ -360,7 +813,51 @@ async def set_model_reasoner(message: Message) -> None:
             "🔹 Теперь будет использоваться Chain-of-Thought подход"
         )
     except Exception as e:
-        logger.error(f"Error setting model_reasoner for user {user_id}: {str(e)}")
+        logger.error("Error setting model_reasoner for user %s: %s", user_id, e)
+        error_details = f"Ошибка: {str(e)}" if str(e) else "Неизвестная ошибка"
+        await message.reply(
+            f"⚠️ Ошибка при изменении модели\n"
+            f"🔹 {error_details}\n"
+            f"🔹 Для полного сброса используйте /new"
+        )
+
+@router.message(Command("model_auto"))
+async def set_model_auto(message: Message) -> None:
+    """Режим auto: модель выбирается под каждый запрос локальным классификатором
+    
+    Args:
+        message: Входящее сообщение с командой
+    """
+    user_id = message.from_user.id
+    
+    try:
+        model = get_user_model(user_id)
+        if model == AUTO_MODEL:
+            await message.reply("✅ Автоматический выбор модели уже включен")
+            return
+
+        set_user_model(user_id, AUTO_MODEL)
+
+        # Запись остается в текущем диалоге, иначе он перестанет быть последним
+        save_interaction(
+            user_id=user_id,
+            conversation_id=await _get_conversation_id(user_id),
+            message_type='system',
+            content='model_change_to_auto',
+            tokens=0,
+            cost=0,
+            timestamp=time.time(),
+            model_name='system'
+        )
+
+        # Контекст не очищаем: история собирается корректно для обеих моделей
+        await message.reply(
+            "✅ Включен автоматический выбор модели\n"
+            "🔹 Простые вопросы — deepseek-chat\n"
+            "🔹 Код, математика и сложные задачи — deepseek-reasoner"
+        )
+    except Exception as e:
+        logger.error("Error setting model_auto for user %s: %s", user_id, e)
         error_details = f"Ошибка: {str(e)}" if str(e) else "Неизвестная ошибка"
         await message.reply(
             f"⚠️ Ошибка при изменении модели\n"
@@ -373,66 +870,519 @@ async def _get_conversation_id(user_id: int) -> str:
     if not isinstance(user_id, int):
         raise ValueError("user_id must be integer")
     
-    conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Check if interactions table exists with required columns
-        cursor.execute("PRAGMA table_info(interactions)")
-        columns = [col[1] for col in cursor.fetchall()]
-        required_columns = {'user_id', 'conversation_id', 'timestamp'}
-        
-        if not required_columns.issubset(columns):
-            return str(uuid.uuid4())
-            
-        cursor.execute('''
-            SELECT conversation_id FROM interactions 
-            WHERE user_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT 1
-        ''', (user_id,))
-        result = cursor.fetchone()
+        conversation_id = get_current_conversation_id(user_id)
     except sqlite3.Error as e:
-        logging.error(f"Database error in _get_conversation_id: {e}")
+        logging.error("Database error in _get_conversation_id: %s", e)
         return str(uuid.uuid4())
+    return conversation_id or str(uuid.uuid4())
+
+def _load_history(user_id: int, conversation_id: str) -> list:
+    """
+    История диалога в порядке сохранения в пределах HISTORY_MAX_TOKENS.
+    
+    Начало окна сдвигается только при переполнении (см. get_context_window),
+    поэтому между сдвигами префикс запроса не меняется и берется из кэша DeepSeek.
+    
+    Args:
+        user_id: ID пользователя
+        conversation_id: ID диалога
+    
+    Returns:
+        list: Сообщения в формате {"role": "...", "content": "..."}
+    """
+    return get_context_window(user_id, conversation_id, HISTORY_MAX_TOKENS)
+
+def _build_messages(history: list, prompt: str, model: str) -> list:
+    """
+    Сборка запроса к модели: история диалога + новый промпт.
+    
+    История только дописывается в конец и никогда не переписывается, поэтому
+    сообщения прошлых ходов остаются байт-в-байт одинаковыми между запросами
+    и DeepSeek берет их из кэша префикса.
+    
+    Args:
+        history: Сообщения контекста в порядке сохранения
+        prompt: Новый запрос пользователя
+        model: Имя модели
+    """
+    if model != "deepseek-reasoner":
+        # Для deepseek-chat используем полную историю
+        return history + [{"role": "user", "content": prompt}]
+
+    # Для deepseek-reasoner нужны строго чередующиеся Q&A пары (без reasoning)
+    messages = []
+    for msg in history:
+        if msg["role"] == "user":
+            # Добавляем user сообщение только если предыдущее было assistant или список пуст
+            if not messages or messages[-1]["role"] == "assistant":
+                messages.append({"role": "user", "content": msg["content"]})
+        elif msg["role"] == "assistant":
+            content = msg["content"]
+            # Если это был ответ reasoner, извлекаем только answer часть
+            if content.startswith('{"reasoning"'):
+                try:
+                    content = json.loads(content)["answer"]
+                except:
+                    content = content.split('"answer":')[1].split('"')[1]
+            # Добавляем assistant сообщение только если перед ним есть user сообщение
+            if messages and messages[-1]["role"] == "user":
+                messages.append({"role": "assistant", "content": content})
+
+    # Вопрос без ответа (оборванный ход) отбрасываем целиком, не подменяя его текст
+    if messages and messages[-1]["role"] == "user":
+        messages = messages[:-1]
+    return messages + [{"role": "user", "content": prompt}]
+
+def _resolve_model(user_id: int, conversation_id: str, model: str, prompt: str,
+                   history: Optional[list] = None) -> str:
+    """
+    Для режима auto выбирает модель под конкретный запрос и сохраняет решение в лог
+    
+    Args:
+        user_id: ID пользователя
+        conversation_id: ID диалога
+        model: Модель из настроек пользователя
+        prompt: Текст запроса
+        history: Сообщения контекста
+    
+    Returns:
+        str: Имя модели для запроса к API
+    """
+    if model != AUTO_MODEL:
+        return model
+
+    routed_model, reason = choose_model(prompt, history)
+    logger.info("Auto routing for user %s: %s (%s)", user_id, routed_model, reason)
+    save_interaction(
+        user_id=user_id,
+        conversation_id=conversation_id,
+        message_type='system',
+        content=f'auto_route:{reason}',
+        tokens=0,
+        cost=0,
+        timestamp=time.time(),
+        model_name=routed_model
+    )
+    return routed_model
+
+async def _complete(model: str, messages: list) -> tuple:
+    """
+    Нестриминговый запрос к модели
+    
+    Returns:
+        tuple: (текст ответа, usage в формате parse_usage)
+    """
+    response = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.7
+    )
+    answer = response.choices[0].message.content or ""
+    tokens_out = num_tokens_from_messages([{"role": "assistant", "content": answer}], model=model)
+    return answer, parse_usage(response.usage, model, messages, tokens_out)
+
+def _save_completion(user_id: int, conversation_id: str, model: str, prompt: str, answer: str,
+                     usage: dict, start_time: float, end_time: float, purpose: str = 'dialog') -> None:
+    """Сохраняет промпт и ответ одного запроса к модели вместе со стоимостью и назначением (purpose)"""
+    save_interaction(
+        user_id=user_id,
+        conversation_id=conversation_id,
+        message_type='prompt',
+        content=prompt,
+        tokens=usage["prompt_tokens"],
+        cost=calculate_prompt_cost(model, usage["cache_hit_tokens"], usage["cache_miss_tokens"]),
+        timestamp=start_time,
+        model_name=model,
+        cache_hit_tokens=usage["cache_hit_tokens"],
+        cache_miss_tokens=usage["cache_miss_tokens"],
+        purpose=purpose
+    )
+    save_interaction(
+        user_id=user_id,
+        conversation_id=conversation_id,
+        message_type='response',
+        content=answer,
+        tokens=usage["completion_tokens"],
+        cost=calculate_cost(model=model, tokens=usage["completion_tokens"], token_type="output"),
+        timestamp=end_time,
+        model_name=model,
+        purpose=purpose
+    )
+
+async def _map_reduce(message: Message, wait_msg: Message, conversation_id: str, model: str,
+                      instruction: str, chunks: List[str], source: str) -> None:
+    """
+    Обработка большого текста по частям: параллельные запросы по фрагментам (map)
+    с ограничением одновременных вызовов и итоговый запрос по их результатам (reduce)
+    
+    Args:
+        message: Сообщение пользователя, на которое отвечает бот
+        wait_msg: Сообщение ожидания, в котором показывается прогресс и итоговый ответ
+        conversation_id: ID диалога
+        model: Имя модели
+        instruction: Задание пользователя
+        chunks: Фрагменты текста, не превышающие CHUNK_TOKENS
+        source: Описание источника текста (имя файла и т.п.)
+    """
+    user_id = message.from_user.id
+    semaphore = asyncio.Semaphore(MAP_REDUCE_CONCURRENCY)
+    start_time = time.time()
+    # До этого момента Telegram не принимает правки (flood control)
+    retry_until = 0
+
+    async def update_progress(text: str) -> None:
+        # Прогресс — косметика: его ошибки не должны прерывать уже оплаченную обработку частей
+        nonlocal retry_until
+        if time.time() < retry_until:
+            return
+        try:
+            await wait_msg.edit_text(text)
+        except TelegramRetryAfter as e:
+            retry_until = time.time() + e.retry_after
+            logger.warning("Flood control on progress message, retry after %ss", e.retry_after)
+        except TelegramAPIError as e:
+            logger.error("Failed to update progress message: %s", e)
+
+    async def process_chunk(index: int, total: int, chunk: str, progress: dict) -> str:
+        content = MAP_PROMPT.format(
+            instruction=instruction, index=index, total=total, source=source, chunk=chunk)
+        async with semaphore:
+            chunk_start = time.time()
+            answer, usage = await _complete(model, [{"role": "user", "content": content}])
+        _save_completion(user_id, conversation_id, model, content, answer,
+                         usage, chunk_start, time.time(), purpose='map')
+
+        progress["done"] += 1
+        # Не редактируем сообщение чаще раза в секунду, чтобы не упереться в лимиты Telegram
+        if progress["done"] == total or time.time() - progress["updated"] >= 1:
+            progress["updated"] = time.time()
+            await update_progress(f"⏳ Обработано частей: {progress['done']}/{total}")
+        return answer
+
+    if len(chunks) == 1:
+        reduce_prompt = SINGLE_CHUNK_PROMPT.format(instruction=instruction, source=source, chunk=chunks[0])
+    else:
+        for round_number in range(1, MAP_REDUCE_MAX_ROUNDS + 1):
+            total = len(chunks)
+            progress = {"done": 0, "updated": 0}
+            await update_progress(f"⏳ Текст разбит на {total} частей, обрабатываю...")
+            tasks = [
+                asyncio.create_task(process_chunk(i, total, chunk, progress))
+                for i, chunk in enumerate(chunks, 1)
+            ]
+            try:
+                partials = await asyncio.gather(*tasks)
+            except BaseException:
+                # Ошибка одной части отменяет остальные, чтобы они не продолжали платные запросы
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+
+            joined = "\n\n".join(f"[{i}] {partial.strip()}" for i, partial in enumerate(partials, 1))
+            reduce_prompt = REDUCE_PROMPT.format(
+                instruction=instruction, total=total, source=source, partials=joined)
+            if num_tokens_from_messages([{"role": "user", "content": reduce_prompt}], model=model) <= MAX_PROMPT_TOKENS:
+                break
+
+            # Результаты частей все еще не помещаются в контекст — сворачиваем их еще раз,
+            # но только пока это сокращает текст и не исчерпан лимит раундов
+            chunks = list(split_text_by_tokens(joined.splitlines(keepends=True), CHUNK_TOKENS, model=model))
+            if round_number == MAP_REDUCE_MAX_ROUNDS or len(chunks) >= total:
+                logger.error("Map-reduce for user %s did not converge: %s parts after round %s",
+                             user_id, len(chunks), round_number)
+                raise RuntimeError("Промежуточные результаты слишком длинные, сократите текст или уточните задание")
+            source = f"промежуточные результаты: {source}"
+
+    await update_progress("⏳ Формирую итоговый ответ...")
+    reduce_start = time.time()
+    answer_text, usage = await _complete(model, [{"role": "user", "content": reduce_prompt}])
+    end_time = time.time()
+    # В контекст диалога попадает только задание и итоговый ответ. Итоговый запрос
+    # сохраняется как реплика диалога с тем же текстом, что и в контексте, чтобы
+    # restore_conversation восстановил диалог таким, каким его видел пользователь;
+    # ответы частей, из которых собран reduce-промпт, уже записаны с purpose='map'
+    user_turn = f"[{source}] {instruction}"
+    _save_completion(user_id, conversation_id, model, user_turn, answer_text,
+                     usage, reduce_start, end_time)
+    save_context(user_id, conversation_id, 'user', user_turn, start_time)
+    save_context(user_id, conversation_id, 'assistant', answer_text, end_time)
+
+    # Итоговый ответ нельзя пропустить — дожидаемся окончания ограничения
+    if retry_until > time.time():
+        await asyncio.sleep(retry_until - time.time())
+    await send_long_message(message, answer_text.strip() or "Пустой ответ модели", edit_message=wait_msg)
+
+async def _stream_to_message(message: Message, reply_msg: Message, model: str,
+                             messages: list, header: Optional[str] = None) -> dict:
+    """
+    Стриминг ответа модели с периодическим обновлением сообщения в Telegram
+    
+    Args:
+        message: Сообщение пользователя, на которое отвечает бот
+        reply_msg: Сообщение бота, которое обновляется по мере генерации
+        model: Имя модели
+        messages: Сообщения запроса
+        header: Заголовок ответа (имя модели в /compare), None — без заголовка
+    
+    Returns:
+        dict: reasoning, answer, usage, start_time, first_token_time, end_time
+    """
+    start_time = time.time()
+    first_token_time = None
+    last_edit_time = 0
+    # До этого момента Telegram не принимает правки (flood control)
+    retry_until = 0
+    prefix = f"{header}\n\n" if header else ""
+    reasoning_text = ""
+    answer_text = ""
+    tokens_out = 0
+    stream_usage = None
+
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.7,
+        stream=True,
+        extra_body={"stream_options": {"include_usage": True}}
+    )
+    async for chunk in stream:
+        if getattr(chunk, 'usage', None):
+            stream_usage = chunk.usage
+        if not chunk.choices:
+            continue
+
+        delta = chunk.choices[0].delta
+        if getattr(delta, 'reasoning_content', None):
+            reasoning_text += delta.reasoning_content
+            tokens_out += 1
+        if getattr(delta, 'content', None):
+            answer_text += delta.content
+            tokens_out += 1
+        if first_token_time is None and (reasoning_text or answer_text):
+            first_token_time = time.time()
+
+        now = time.time()
+        if now - last_edit_time >= STREAM_EDIT_INTERVAL and now >= retry_until:
+            last_edit_time = now
+            body = answer_text or f"🧠 Рассуждает...\n\n{reasoning_text}"
+            # Пока идет генерация, показываем хвост текста в пределах одного сообщения
+            if len(body) > 3800:
+                body = "…" + body[-3800:]
+            try:
+                await reply_msg.edit_text(prefix + body)
+            except TelegramRetryAfter as e:
+                # Промежуточные правки пропускаем, стрим при этом не прерывается
+                retry_until = time.time() + e.retry_after
+                logger.warning("Flood control on streamed message, retry after %ss", e.retry_after)
+            except TelegramBadRequest as e:
+                logger.error("Failed to update streamed message: %s", e)
+
+    end_time = time.time()
+    if reasoning_text.strip():
+        final_text = (f"{prefix}\U0001F9E0 Рассуждения:\n\n{reasoning_text.strip()}"
+                      f"\n\n\U0001F4A1 Ответ:\n\n{answer_text.strip()}")
+    else:
+        final_text = prefix + (answer_text.strip() or "Пустой ответ модели")
+    # Итоговый ответ нельзя пропустить — дожидаемся окончания ограничения
+    if retry_until > time.time():
+        await asyncio.sleep(retry_until - time.time())
+    await send_long_message(message, final_text, edit_message=reply_msg)
+
+    return {
+        "reasoning": reasoning_text,
+        "answer": answer_text,
+        "usage": parse_usage(stream_usage, model, messages, tokens_out),
+        "start_time": start_time,
+        "first_token_time": first_token_time or end_time,
+        "end_time": end_time
+    }
+
+@router.message(Command("compare"))
+async def compare_models(message: Message) -> None:
+    """Одновременный запрос к deepseek-chat и deepseek-reasoner с текущим контекстом.
+    Контекст диалога не меняется
+    
+    Args:
+        message: Входящее сообщение с командой /compare <запрос>
+    """
+    user_id = message.from_user.id
+    args = message.text.split(maxsplit=1)
+    
+    if len(args) != 2 or not args[1].strip():
+        await message.reply("Используйте: /compare <запрос>")
+        return
+    prompt = args[1].strip()
+
+    if not await _check_authorization(message):
+        return
+
+    # Проверяем есть ли активный запрос для этого пользователя
+    last_request_time = active_requests.get(user_id)
+    if last_request_time and time.time() - last_request_time < REQUEST_TIMEOUT:
+        await message.reply("Ожидайте ответа, после этого попробуйте еще раз.")
+        return
+
+    active_requests[user_id] = time.time()
+    try:
+        # Оба ответа логируются под текущим диалогом, чтобы не сменить активный контекст
+        conversation_id = await _get_conversation_id(user_id)
+        bind_log_context(conversation_id=conversation_id)
+        history = _load_history(user_id, conversation_id)
+        replies = [await message.reply(f"🔹 {model}\n\n⏳ Ожидайте ответ...") for model in COMPARE_MODELS]
+
+        results = await asyncio.gather(
+            *(
+                _stream_to_message(message, reply_msg, model, _build_messages(history, prompt, model), f"🔹 {model}")
+                for model, reply_msg in zip(COMPARE_MODELS, replies)
+            ),
+            return_exceptions=True
+        )
+
+        for model, result in zip(COMPARE_MODELS, results):
+            if isinstance(result, Exception):
+                logger.error("Compare request to %s failed for user %s: %s", model, user_id, result)
+                await message.reply(f"Ошибка при обращении к {model}:\n\n{result}")
+                continue
+
+            logger.info(
+                "Compare %s for user %s: first token %.2fs, total %.2fs, tokens %s/%s",
+                model, user_id,
+                result['first_token_time'] - result['start_time'],
+                result['end_time'] - result['start_time'],
+                result['usage']['prompt_tokens'], result['usage']['completion_tokens']
+            )
+            _save_completion(
+                user_id, conversation_id, model, prompt,
+                result["answer"] if not result["reasoning"] else json.dumps({
+                    "reasoning": result["reasoning"].strip(),
+                    "answer": result["answer"].strip()
+                }),
+                result["usage"], result["start_time"], result["end_time"], purpose='compare'
+            )
+    except Exception as e:
+        logger.error("Error comparing models for user %s: %s", user_id, e)
+        await message.reply("⚠️ Ошибка при сравнении моделей")
     finally:
-        if conn:
-            conn.close()
-    return result[0] if result else str(uuid.uuid4())
+        active_requests.pop(user_id, None)
+        await _profile_request_finished()
 
-@router.message()
-async def handle_message(message: Message):
+async def _iter_document_lines(document: types.Document) -> AsyncGenerator[str, None]:
+    """
+    Построчное чтение документа из Telegram потоком, без загрузки файла в память целиком
+    
+    Args:
+        document: Документ из входящего сообщения
+    """
+    file = await bot.get_file(document.file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    tail = ""
+    async for data in bot.session.stream_content(url=url, raise_for_status=True):
+        tail += decoder.decode(data)
+        lines = tail.splitlines(keepends=True)
+        # Последняя строка может быть не дочитана
+        tail = lines.pop() if lines and not lines[-1].endswith(("\n", "\r")) else ""
+        for line in lines:
+            yield line
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+@router.message(F.document)
+async def handle_document(message: Message) -> None:
+    """
+    Обработка загруженных текстовых файлов. Подпись к файлу используется как задание
+    
+    Args:
+        message: Входящее сообщение с документом
+    """
+    user_id = message.from_user.id
+
+    if not await _check_authorization(message):
+        return
+
+    document = message.document
+    extension = os.path.splitext(document.file_name or "")[1].lower()
+    if not ((document.mime_type or "").startswith("text/") or extension in TEXT_DOCUMENT_EXTENSIONS):
+        await message.reply("Поддерживаются только текстовые файлы (txt, md, исходный код и т.п.)")
+        return
+    if document.file_size and document.file_size > MAX_DOCUMENT_SIZE:
+        await message.reply("Файл слишком большой, максимум 20 МБ")
+        return
+
+    # Проверяем есть ли активный запрос для этого пользователя
+    last_request_time = active_requests.get(user_id)
+    if last_request_time and time.time() - last_request_time < REQUEST_TIMEOUT:
+        await message.reply("Ожидайте ответа, после этого попробуйте еще раз.")
+        return
+
+    active_requests[user_id] = time.time()
+    try:
+        wait_msg = await message.reply("Файл принят, читаю...")
+        conversation_id = await _get_conversation_id(user_id)
+        instruction = (message.caption or "").strip() or DOCUMENT_INSTRUCTION
+        model = _resolve_model(user_id, conversation_id, get_user_model(user_id), instruction)
+        bind_log_context(conversation_id=conversation_id, model=model)
+
+        # Части собираются по мере загрузки файла: текст хранится в памяти один раз, уже разбитым
+        chunks = [
+            chunk async for chunk in asplit_text_by_tokens(
+                _iter_document_lines(document), CHUNK_TOKENS, model=model)
+        ]
+        if not chunks:
+            await wait_msg.edit_text("Файл пуст.")
+            return
+
+        source = f"файл {document.file_name or 'без имени'}"
+        await _map_reduce(message, wait_msg, conversation_id, model, instruction, chunks, source)
+    except Exception as e:
+        logger.error("Error processing document for user %s: %s", user_id, e)
+        await message.reply(f"Ошибка при обработке файла:\n\n{e}")
+    finally:
+        active_requests.pop(user_id, None)
+        await _profile_request_finished()
+
+async def _check_authorization(message: Message) -> bool:
+    """
+    Проверка авторизации пользователя с кэшированием. При отказе отвечает пользователю
+    
+    Args:
+        message: Входящее сообщение
+    
+    Returns:
+        bool: True, если пользователь авторизован
+    """
     user_id = message.from_user.id
     
     # Проверяем кэш авторизации
     if user_id in authorized_users:
         if not authorized_users[user_id]:
             await message.reply("❌ Доступ запрещен. Используйте /auth <ключ> для авторизации.")
-            return
+            return False
     else:
         try:
-            # Проверяем существование таблицы user_settings
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_settings'")
-                if not cursor.fetchone():
-                    init_db()
-                
-                # Проверяем авторизацию
-                cursor.execute('SELECT is_authorized FROM user_settings WHERE user_id = ?', (user_id,))
-                result = cursor.fetchone()
-                
-            if not result or not result[0]:
+            # Проверяем авторизацию (таблицы создаются при первом обращении)
+            if not is_user_authorized(user_id):
                 authorized_users[user_id] = False
                 await message.reply("❌ Доступ запрещен. Используйте /auth <ключ> для авторизации.")
-                return
+                return False
             else:
                 authorized_users[user_id] = True
         except Exception as e:
-            logger.error(f"Error checking authorization for user {user_id}: {e}")
+            logger.error("Error checking authorization for user %s: %s", user_id, e)
             await message.reply("⚠️ Ошибка проверки авторизации. Попробуйте снова.")
-            return
+            return False
+    
+    return True
+
+@router.message()
+async def handle_message(message: Message):
+    user_id = message.from_user.id
+    
+    if not await _check_authorization(message):
+        return
     
     # Проверяем есть ли активный запрос для этого пользователя
     last_request_time = active_requests.get(user_id)
@@ -444,133 +1394,117 @@ async def handle_message(message: Message):
             # Сбрасываем зависший запрос
             active_requests.pop(user_id, None)
         
-    # Пропускаем команды и пустые сообщения
-    if not message.text or message.text.startswith('/'):
+    # Пропускаем команды и пустые сообщения (для пересланных медиа берем подпись)
+    text = _message_text(message)
+    if not text or text.startswith('/'):
         return
+
+    # Складываем сообщение в буфер и откладываем отправку: подряд идущие части
+    # длинного текста или пачки пересланных сообщений уйдут одним запросом
+    pending_messages.setdefault(user_id, []).append(message)
+    flush_task = pending_flush_tasks.get(user_id)
+    if flush_task:
+        flush_task.cancel()
+    pending_flush_tasks[user_id] = _spawn_background(_flush_pending_messages(user_id))
+
+def _message_text(message: Message) -> Optional[str]:
+    """
+    Текст сообщения для промпта
+    
+    Подпись к медиа используется только у пересланных сообщений: собственное фото
+    или голосовое с подписью модель без вложения все равно не поймет.
+    
+    Args:
+        message: Сообщение пользователя
         
+    Returns:
+        Optional[str]: Текст, подпись пересланного сообщения или None
+    """
+    if message.text:
+        return message.text
+    if message.forward_origin or message.forward_date:
+        return message.caption
+    return None
+
+async def _flush_pending_messages(user_id: int) -> None:
+    """
+    Склеивает накопленные за окно ожидания сообщения пользователя в один промпт
+    
+    Args:
+        user_id: ID пользователя
+    """
+    await asyncio.sleep(MESSAGE_DEBOUNCE_DELAY)
+
+    # После окна ожидания задача уже не отменяется новыми сообщениями;
+    # ссылку на нее до завершения держит background_tasks
+    pending_flush_tasks.pop(user_id, None)
+    messages = sorted(pending_messages.pop(user_id, []), key=lambda m: m.message_id)
+    if not messages:
+        return
+
+    message = messages[0]
+    prompt = "\n".join(
+        _message_text(m).strip() for m in messages if _message_text(m)
+    ).strip()
+    if not prompt:
+        await message.reply("Сообщение не может быть пустым")
+        return
+
     # Устанавливаем флаг активного запроса с timestamp
     active_requests[user_id] = time.time()
+    try:
+        await _process_prompt(message, prompt)
+    except Exception as e:
+        logger.error("Error processing merged prompt for user %s: %s", user_id, e)
+        active_requests.pop(user_id, None)
+    finally:
+        await _profile_request_finished()
+
+async def _process_prompt(message: Message, prompt: str) -> None:
+    """
+    Отправка промпта в модель, стриминг ответа и сохранение в БД
     
+    Args:
+        message: Сообщение, на которое отвечает бот
+        prompt: Итоговый текст запроса
+    """
+    user_id = message.from_user.id
+
     try:
-        user_input = message.text.strip()
-        if not user_input:
-            await message.reply("Сообщение не может быть пустым")
-            return
         # Сообщаем пользователю, что запрос принят
         wait_msg = await message.reply("Ваш запрос принят, ожидайте ответ!")
     except Exception as e:
-        logging.error(f"Error processing message: {e}")
+        logging.error("Error processing message: %s", e)
         await message.reply("Произошла ошибка при обработке сообщения")
         active_requests.pop(user_id, None)  # Снимаем блокировку при ошибке
         return
-    
-        
-    prompt = user_input.strip()
-    user_id = message.from_user.id
+
     conversation_id = await _get_conversation_id(user_id)
-    if not prompt:  # Проверяем, что промпт не пустой
-        await message.reply("Пожалуйста, введите запрос после секретного слова")
-        return
-        
-    user_id = message.from_user.id
     username = message.from_user.username or "unknown"
 
     model = get_user_model(user_id)
-    
-    # Получаем историю диалога (последние 10 сообщений)
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Проверяем существование таблицы conversation_context
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='conversation_context'")
-    if not cursor.fetchone():
-        history = []
-    else:
-        cursor.execute('''
-            SELECT role, content FROM conversation_context
-            WHERE user_id = ? AND conversation_id = ?
-            ORDER BY timestamp ASC
-            LIMIT 10
-        ''', (user_id, conversation_id))
-        history = [{"role": row[0], "content": row[1]} for row in cursor.fetchall()]
-    conn.close()
-    
-    # Для deepseek-reasoner используем только Q&A пары (без reasoning)
-    if model == "deepseek-reasoner":
-        messages = []
-        # Фильтруем только user/assistant сообщения (исключая reasoning)
-        for msg in history:
-            if msg["role"] == "user":
-                # Добавляем user сообщение только если предыдущее было assistant или список пуст
-                if not messages or messages[-1]["role"] == "assistant":
-                    messages.append({"role": msg["role"], "content": msg["content"]})
-            elif msg["role"] == "assistant":
-                content = msg["content"]
-                # Если это был ответ reasoner, извлекаем только answer часть
-                if content.startswith('{"reasoning"'):
-                    try:
-                        content = json.loads(content)["answer"]
-                    except:
-                        content = content.split('"answer":')[1].split('"')[1]
-                # Добавляем assistant сообщение только если перед ним есть user сообщение
-                if messages and messages[-1]["role"] == "user":
-                    messages.append({"role": msg["role"], "content": content})
-        
-        # Убедимся, что первый message - user (если список пуст)
-        if not messages:
-            messages.append({"role": "user", "content": prompt})
-        # Если последнее сообщение - assistant, добавляем новый user prompt
-        elif messages[-1]["role"] == "assistant":
-            messages.append({"role": "user", "content": prompt})
-        # Если последнее сообщение - user, заменяем его на новый prompt
-        else:
-            messages[-1]["content"] = prompt
-    else:
-        # Для deepseek-chat используем полную историю
-        messages = history + [{"role": "user", "content": prompt}]
-    tokens_in = num_tokens_from_messages(messages, model=model)
 
-    start_time = time.time()
-    reply_text = ""
-    sent_message = None
-    tokens_out = 0
-    
-    # Инициализация буфера
-    accumulated_text = ""
-    last_sent_text = ""
-    last_update_time = 0
-    
-    try:
-        stream = await client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.7,
-            stream=True
-        )
-        
-        reasoning_text = ""
-        answer_text = ""
-        tokens_out = 0
-
-        # Просто накапливаем весь ответ (и рассуждения, если есть)
-        async for chunk in stream:
-            # Обработка reasoning для reasoner модели
-            if model == "deepseek-reasoner" and hasattr(chunk.choices[0].delta, 'reasoning_content'):
-                reasoning_text += chunk.choices[0].delta.reasoning_content or ""
-                tokens_out += 1
-
-            # Обработка основного ответа
-            if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
-                answer_text += chunk.choices[0].delta.content
-                tokens_out += 1
-
-        # После завершения стрима финальный ответ заменяет сообщение "Ваш запрос принят"
-        if answer_text.strip():
-            if model == "deepseek-reasoner":
-                await send_long_message(message, f"\U0001F9E0 Рассуждения:\n\n{reasoning_text.strip()}\n\n\U0001F4A1 Ответ:\n\n{answer_text.strip()}", edit_message=wait_msg)
-            else:
-                await send_long_message(message, answer_text.strip(), edit_message=wait_msg)
+    # Получаем историю диалога
+    history = _load_history(user_id, conversation_id)
+    model = _resolve_model(user_id, conversation_id, model, prompt, history)
+    bind_log_context(conversation_id=conversation_id, model=model)
 
+    # Слишком длинный промпт не поместится в контекст модели — обрабатываем его по частям
+    if num_tokens_from_messages([{"role": "user", "content": prompt}], model=model) > MAX_PROMPT_TOKENS:
+        try:
+            chunks = list(split_text_by_tokens(prompt.splitlines(keepends=True), CHUNK_TOKENS, model=model))
+            await _map_reduce(message, wait_msg, conversation_id, model,
+                              LONG_PROMPT_INSTRUCTION, chunks, "длинное сообщение пользователя")
+        except Exception as e:
+            logger.error("Error processing long prompt for user %s: %s", user_id, e)
+            await message.reply(f"Ошибка при обращении к GPT:\n\n{e}")
+        finally:
+            active_requests.pop(user_id, None)
+        return
+
+    messages = _build_messages(history, prompt, model)
+    try:
+        result = await _stream_to_message(message, wait_msg, model, messages)
     except Exception as e:
         await message.reply(f"Ошибка при обращении к GPT:\n\n{e}")
         return
@@ -578,59 +1512,19 @@ async def handle_message(message: Message):
         # Всегда снимаем блокировку после завершения обработки
         active_requests.pop(user_id, None)
 
-    # Фиксируем время окончания генерации ответа
-    end_time = time.time()
-
-    # Рассчитываем стоимость отдельно для промпта и ответа
-    prompt_cost = calculate_cost(model=model, tokens=tokens_in, token_type="input")
-    response_cost = calculate_cost(model=model, tokens=tokens_out, token_type="output")
-    total_cost = round(prompt_cost + response_cost, 6)
-
-    # Сохраняем промпт
-    save_interaction(
-        user_id=user_id,
-        conversation_id=conversation_id,
-        message_type='prompt',
-        content=prompt,
-        tokens=tokens_in,
-        cost=prompt_cost,
-        timestamp=start_time,
-        model_name=model
-    )
-    
-    # Сохраняем ответ
-    save_interaction(
-        user_id=user_id,
-        conversation_id=conversation_id,
-        message_type='response',
-        content=answer_text if model != "deepseek-reasoner" else json.dumps({
-            "reasoning": reasoning_text.strip(),
-            "answer": answer_text.strip()
+    # Сохраняем промпт и ответ; стоимость промпта считается с учетом кэша префикса
+    _save_completion(
+        user_id, conversation_id, model, prompt,
+        result["answer"] if model != "deepseek-reasoner" else json.dumps({
+            "reasoning": result["reasoning"].strip(),
+            "answer": result["answer"].strip()
         }),
-        tokens=tokens_out,
-        cost=response_cost,
-        timestamp=end_time,
-        model_name=model
+        result["usage"], result["start_time"], result["end_time"]
     )
-    
+
     # Сохраняем в контекст
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Проверяем существование таблицы conversation_context
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='conversation_context'")
-    if cursor.fetchone():
-        cursor.execute('''
-            INSERT INTO conversation_context (user_id, conversation_id, role, content, timestamp)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, conversation_id, 'user', prompt, start_time))
-        
-        cursor.execute('''
-            INSERT INTO conversation_context (user_id, conversation_id, role, content, timestamp)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, conversation_id, 'assistant', answer_text, end_time))
-        conn.commit()
-    conn.close()
+    save_context(user_id, conversation_id, 'user', prompt, result["start_time"])
+    save_context(user_id, conversation_id, 'assistant', result["answer"], result["end_time"])
 
 async def main():
     # Initialize database before starting bot
@@ -638,9 +1532,21 @@ async def main():
         init_db()
         logging.info("Database initialized successfully")
     except Exception as e:
-        logging.error(f"Failed to initialize database: {e}")
+        logging.error("Failed to initialize database: %s", e)
         raise
     
+    # SIGUSR1 включает/выключает профилирование без команды в Telegram
+    if hasattr(signal, "SIGUSR1"):
+        def toggle_profiling() -> None:
+            if profiler.active:
+                _spawn_background(_finish_profiling())
+            else:
+                _start_profiling(seconds=PROFILE_DEFAULT_SECONDS)
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_profiling)
+        except NotImplementedError:
+            pass
+    
     dp.include_router(router)
     await dp.start_polling(bot)
 
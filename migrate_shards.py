@@ -0,0 +1,114 @@
+# migrate_shards.py
+#
+# Разбиение существующей БД (один файл) на шарды по user_id.
+#
+#   python migrate_shards.py --shards 4
+#   python migrate_shards.py --shards 4 --source bd/chatgpt_telegram_log.db
+#
+# Исходный файл не изменяется. После миграции запускайте бота с DB_SHARDS=<N>.
+
+import argparse
+import os
+import sqlite3
+import sys
+
+import database
+
+# Таблицы с данными пользователей в порядке копирования
+TABLES = ("user_settings", "interactions", "conversation_context", "context_windows")
+BATCH_SIZE = 1000
+
+
+def _columns(conn, table):
+    return [col[1] for col in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _has_data(path):
+    if not os.path.exists(path):
+        return False
+    with sqlite3.connect(path) as conn:
+        for table in TABLES:
+            try:
+                if conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                    return True
+            except sqlite3.OperationalError:
+                continue
+    return False
+
+
+def migrate(source, shards):
+    """
+    Копирует все строки из source в шарды, выбирая шард по user_id
+
+    Returns:
+        dict: Путь к шарду -> количество скопированных строк
+    """
+    database.DB_SHARDS = shards
+    paths = database.get_all_db_paths()
+    not_empty = [path for path in paths if _has_data(path)]
+    if not_empty:
+        raise RuntimeError(f"Shards already contain data: {', '.join(not_empty)}")
+
+    database.init_db()
+    targets = {path: sqlite3.connect(path) for path in paths}
+    copied = {path: 0 for path in paths}
+    try:
+        with sqlite3.connect(source) as source_conn:
+            for table in TABLES:
+                # Старые БД могут не иметь новых колонок — для них остаются значения по умолчанию
+                columns = [
+                    column for column in _columns(source_conn, table)
+                    if column in _columns(targets[paths[0]], table)
+                ]
+                if not columns:
+                    continue
+                user_index = columns.index("user_id")
+                insert_sql = (
+                    f"INSERT INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' for _ in columns)})"
+                )
+
+                cursor = source_conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid")
+                while True:
+                    rows = cursor.fetchmany(BATCH_SIZE)
+                    if not rows:
+                        break
+                    by_shard = {}
+                    for row in rows:
+                        by_shard.setdefault(database.get_db_path(row[user_index]), []).append(row)
+                    for path, shard_rows in by_shard.items():
+                        targets[path].executemany(insert_sql, shard_rows)
+                        copied[path] += len(shard_rows)
+
+                for conn in targets.values():
+                    conn.commit()
+    finally:
+        for conn in targets.values():
+            conn.close()
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split the single-file database into user_id shards")
+    parser.add_argument("--shards", type=int, required=True, help="Количество шардов (больше 1)")
+    parser.add_argument("--source", default=database.DB_PATH, help="Исходный файл БД")
+    args = parser.parse_args()
+
+    if args.shards < 2:
+        parser.error("--shards must be at least 2")
+    if not os.path.exists(args.source):
+        parser.error(f"Source database not found: {args.source}")
+
+    try:
+        copied = migrate(args.source, args.shards)
+    except (RuntimeError, sqlite3.Error) as e:
+        print(f"Migration failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    for path, count in copied.items():
+        print(f"{path}: {count} rows")
+    print(f"Done. Start the bot with DB_SHARDS={args.shards}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# profiling.py
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Интервал между снимками стека, в секундах
+PROFILE_INTERVAL = 0.005
+# Колбэк цикла событий дольше этого порога попадает в отчет, в секундах
+SLOW_CALLBACK_DURATION = 0.1
+# Количество функций в сводке
+PROFILE_TOP_FUNCTIONS = 25
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """Собирает предупреждения asyncio о медленных колбэках (режим отладки цикла)"""
+
+    def __init__(self):
+        super().__init__(level=logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith("Executing"):
+            self.records.append(message)
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профайлер потока цикла событий.
+
+    Пока профилирование выключено, никакой работы не выполняется: фоновый поток
+    не запущен, режим отладки asyncio выключен. Во время профилирования отдельный
+    поток каждые PROFILE_INTERVAL секунд снимает стек потока цикла событий, а
+    asyncio сообщает о колбэках дольше SLOW_CALLBACK_DURATION.
+    """
+
+    def __init__(self, output_dir, interval=PROFILE_INTERVAL):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.active = False
+        self.report_chat_id = None
+        self.requests_left = None
+        self.timer = None
+        self._samples = Counter()
+        self._idle_samples = 0
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._loop = None
+        self._loop_debug = False
+        self._slow_callbacks = None
+        self._asyncio_level = logging.NOTSET
+        self._started_at = 0
+
+    def start(self, loop, requests=None, report_chat_id=None):
+        """
+        Запуск профилирования
+
+        Args:
+            loop: Цикл событий, поток которого профилируется
+            requests: Остановить после указанного числа обработанных запросов (None — без лимита)
+            report_chat_id: Чат, куда отправить сводку после остановки
+        """
+        if self.active:
+            raise RuntimeError("Profiler is already running")
+
+        self.active = True
+        self.report_chat_id = report_chat_id
+        self.requests_left = requests
+        self._samples = Counter()
+        self._idle_samples = 0
+        self._started_at = time.time()
+
+        # Медленные колбэки asyncio сообщает только в режиме отладки
+        self._loop = loop
+        self._loop_debug = loop.get_debug()
+        loop.slow_callback_duration = SLOW_CALLBACK_DURATION
+        loop.set_debug(True)
+        self._slow_callbacks = _SlowCallbackHandler()
+        asyncio_logger = logging.getLogger("asyncio")
+        self._asyncio_level = asyncio_logger.level
+        if not asyncio_logger.isEnabledFor(logging.WARNING):
+            asyncio_logger.setLevel(logging.WARNING)
+        asyncio_logger.addHandler(self._slow_callbacks)
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(threading.get_ident(),), name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def request_finished(self):
+        """
+        Учет обработанного запроса
+
+        Returns:
+            bool: True, если лимит запросов исчерпан и профилирование пора остановить
+        """
+        if self.requests_left is None:
+            return False
+        self.requests_left -= 1
+        return self.requests_left <= 0
+
+    def stop(self):
+        """
+        Остановка профилирования и запись отчетов в output_dir
+
+        Returns:
+            tuple: (путь к collapsed-стекам, путь к сводке, текст сводки)
+        """
+        if not self.active:
+            raise RuntimeError("Profiler is not running")
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        self._loop.set_debug(self._loop_debug)
+        asyncio_logger = logging.getLogger("asyncio")
+        asyncio_logger.removeHandler(self._slow_callbacks)
+        asyncio_logger.setLevel(self._asyncio_level)
+        self.active = False
+
+        stamp = time.strftime("%Y%m%d_%H%M%S", time.localtime(self._started_at))
+        collapsed_path = os.path.join(self.output_dir, f"profile_{stamp}.collapsed")
+        summary_path = os.path.join(self.output_dir, f"profile_{stamp}.txt")
+
+        # Формат collapsed stacks: подходит для flamegraph.pl и speedscope
+        with open(collapsed_path, "w", encoding="utf-8") as f:
+            for stack, count in self._samples.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        summary = self._summary(time.time() - self._started_at)
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.write(summary)
+
+        return collapsed_path, summary_path, summary
+
+    def _run(self, thread_id):
+        """Цикл фонового потока: снимки стека профилируемого потока"""
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            # Ожидание событий в selector — простой цикла, а не работа
+            if frame.f_code.co_name == "select" and frame.f_code.co_filename.endswith("selectors.py"):
+                self._idle_samples += 1
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self._samples[tuple(reversed(stack))] += 1
+
+    def _summary(self, duration):
+        """Текстовая сводка: самые дорогие функции (собственное и полное время) и медленные колбэки"""
+        busy = sum(self._samples.values())
+        total = busy + self._idle_samples
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in self._samples.items():
+            own[stack[-1]] += count
+            for func in set(stack):
+                inclusive[func] += count
+
+        lines = [f"Длительность: {duration:.1f} c, снимков: {total}"]
+        if busy:
+            lines.append(f"Цикл событий занят: {busy / total:.0%}")
+            lines += ["", "Собственное время:"]
+            lines += [f"{count / busy:6.1%}  {func}" for func, count in own.most_common(PROFILE_TOP_FUNCTIONS)]
+            lines += ["", "Полное время (с вызываемыми функциями):"]
+            lines += [f"{count / busy:6.1%}  {func}" for func, count in inclusive.most_common(PROFILE_TOP_FUNCTIONS)]
+        lines += ["", f"Медленные колбэки asyncio (> {SLOW_CALLBACK_DURATION} c): {len(self._slow_callbacks.records)}"]
+        lines += self._slow_callbacks.records[:PROFILE_TOP_FUNCTIONS]
+        return "\n".join(lines) + "\n"
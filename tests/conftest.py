@@ -0,0 +1,37 @@
+import os
+import tempfile
+
+import pytest
+
+# Тестовые БД создаются во временном каталоге, а не в bd/ рабочей копии
+os.environ.setdefault("DB_FOLDER", tempfile.mkdtemp(prefix="deepseek_tgbot_"))
+
+import database  # noqa: E402
+import utils  # noqa: E402
+
+
+class ByteEncoding:
+    """Побайтовый токенизатор: как и BPE tiktoken, режет многобайтовые символы UTF-8 на токены"""
+
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode_bytes(self, tokens):
+        return bytes(tokens)
+
+    def decode(self, tokens):
+        return bytes(tokens).decode("utf-8", errors="replace")
+
+
+@pytest.fixture(autouse=True)
+def byte_encoding(monkeypatch):
+    # Без сети tiktoken не может скачать словарь, поэтому токенизатор подменяется
+    monkeypatch.setattr(utils, "_get_encoding", lambda model: ByteEncoding())
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_SHARDS", 1)
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    database.init_db()
+    return database
@@ -0,0 +1,30 @@
+import sqlite3
+
+
+def _add_turn(db, user_id, conversation_id, turn, size=30):
+    db.save_context(user_id, conversation_id, "user", f"q{turn}".ljust(size, "."), turn)
+    db.save_context(user_id, conversation_id, "assistant", f"a{turn}".ljust(size, "."), turn)
+
+
+def test_context_window_start_moves_only_on_overflow(db):
+    starts = []
+    for turn in range(12):
+        _add_turn(db, 1, "c1", turn)
+        window = db.get_context_window(1, "c1", 400)
+        assert window[0]["role"] == "user"
+        assert window[-1]["content"].startswith(f"a{turn}")
+        starts.append(window[0]["content"].rstrip("."))
+
+    # Ход занимает 85 токенов: при переполнении остается половина бюджета (2 хода),
+    # и до следующего переполнения начало окна не меняется
+    assert starts == ["q0"] * 4 + ["q3"] * 3 + ["q6"] * 3 + ["q9"] * 2
+
+
+def test_context_window_counts_legacy_rows_without_tokens(db):
+    _add_turn(db, 1, "c1", 0)
+    with sqlite3.connect(db.DB_PATH) as conn:
+        conn.execute("UPDATE conversation_context SET tokens = NULL")
+
+    assert len(db.get_context_window(1, "c1", 1000)) == 2
+    with sqlite3.connect(db.DB_PATH) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM conversation_context WHERE tokens IS NULL").fetchone()[0] == 0
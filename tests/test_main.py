@@ -0,0 +1,69 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import config
+
+# Bot проверяет формат токена при создании, а в config.py рабочей копии — заглушка
+config.TELEGRAM_BOT_TOKEN = "123456:TEST-token"
+
+import main  # noqa: E402
+
+
+class FakeMessage:
+    def __init__(self, user_id=1):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.texts = []
+
+    async def edit_text(self, text):
+        self.texts.append(text)
+
+    async def reply(self, text, **kwargs):
+        self.texts.append(text)
+        return FakeMessage()
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    async def create(model, messages, temperature, **kwargs):
+        content = messages[-1]["content"]
+        # Итоговый (reduce) запрос отличается от запросов по частям текстом шаблона
+        answer = "итог" if "результаты обработки" in content else f"ответ по части {len(content)}"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=answer))], usage=None)
+
+    monkeypatch.setattr(main.client.chat.completions, "create", create)
+
+
+def _dialog_turn(user_id, conversation_id, prompt, answer):
+    usage = {"prompt_tokens": 1, "completion_tokens": 1, "cache_hit_tokens": 0, "cache_miss_tokens": 1}
+    now = time.time()
+    main._save_completion(user_id, conversation_id, "deepseek-chat", prompt, answer, usage, now, now)
+    main.save_context(user_id, conversation_id, "user", prompt, now)
+    main.save_context(user_id, conversation_id, "assistant", answer, now)
+
+
+def test_restore_skips_document_chunks_and_compare(db, fake_api):
+    _dialog_turn(1, "c1", "привет", "здравствуйте")
+    chunks = ["первая часть документа", "вторая часть документа", "третья часть документа"]
+    asyncio.run(main._map_reduce(
+        FakeMessage(), FakeMessage(), "c1", "deepseek-chat", "кратко изложи", chunks, "файл doc.txt"))
+    usage = {"prompt_tokens": 1, "completion_tokens": 1, "cache_hit_tokens": 0, "cache_miss_tokens": 1}
+    main._save_completion(1, "c1", "deepseek-reasoner", "сравни", "ответ reasoner", usage,
+                          time.time(), time.time(), purpose="compare")
+    _dialog_turn(1, "c1", "спасибо", "пожалуйста")
+
+    original = [(role, content) for _, role, content, _ in db.iter_context(1, "c1")]
+    assert len(original) == 6
+
+    # /new очищает контекст, затем диалог восстанавливается из найденной истории
+    main.save_interaction(1, "c2", "system", "new_conversation", 0, 0, time.time(), "system")
+    assert db.restore_conversation(1, "c1", time.time()) == len(original)
+
+    restored = [(role, content) for _, role, content, _ in db.iter_context(1, "c1")]
+    assert restored == original
+    assert ("assistant", "итог") in restored
+    assert all("часть документа" not in content and "ответ по части" not in content
+               for _, content in restored)
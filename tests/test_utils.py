@@ -0,0 +1,20 @@
+import pytest
+
+import utils
+
+
+@pytest.mark.parametrize(
+    "text", ["привет мир " * 20, "漢字テキスト" * 15, "🙂👍🚀" * 20], ids=["cyrillic", "cjk", "emoji"])
+def test_split_long_multibyte_line_keeps_characters(text):
+    chunks = list(utils.split_text_by_tokens([text], 25))
+
+    assert len(chunks) > 1
+    assert all("�" not in chunk for chunk in chunks)
+    assert all(len(chunk.encode("utf-8")) <= 25 for chunk in chunks)
+    assert "".join(chunks) == text
+
+
+def test_split_keeps_whole_lines_together():
+    lines = ["abc\n", "def\n", "ghi\n"]
+
+    assert list(utils.split_text_by_tokens(lines, 8)) == ["abc\ndef\n", "ghi\n"]
@@ -1,5 +1,6 @@
 # utils.py
 
+import re
 import tiktoken
 from functools import lru_cache
 
@@ -8,15 +9,57 @@ PRICES = {
     "gpt-4": 0.03,  # для сравнения
     "gpt-3.5-turbo": 0.0015,  # для сравнения
     "deepseek-chat": {
-        "input": 0.27,  # $0.27 за 1M input tokens
+        "input": 0.27,  # $0.27 за 1M input tokens (cache miss)
+        "input_cache_hit": 0.07,  # $0.07 за 1M input tokens из кэша префикса
         "output": 1.10  # $1.10 за 1M output tokens
     },
     "deepseek-reasoner": {
-        "input": 0.55,  # $0.55 за 1M input tokens
+        "input": 0.55,  # $0.55 за 1M input tokens (cache miss)
+        "input_cache_hit": 0.14,  # $0.14 за 1M input tokens из кэша префикса
         "output": 2.19  # $2.19 за 1M output tokens
     }
 }
 
+# Псевдо-модель: выбор deepseek-chat или deepseek-reasoner для каждого запроса
+AUTO_MODEL = "auto"
+
+# Промпт длиннее этого порога (в символах) отправляется в модель с рассуждениями
+AUTO_ROUTE_LONG_PROMPT = 1500
+
+# Признаки кода. Регистр учитывается, а после ключевого слова требуется
+# синтаксис языка, чтобы обычные фразы («Create a poem», «Class schedule») не считались кодом
+_CODE_PATTERN = re.compile(
+    r"```|Traceback \(most recent call last\)|"
+    r"^\s*(async\s+)?def \w+\s*\(|^\s*class \w+\s*[(:{]|"
+    r"^\s*import [\w.]+(\s+as\s+\w+)?\s*;?\s*$|^\s*from [\w.]+ import \w|"
+    r"^\s*#include\s*[<\"]|^\s*(export\s+)?function\s*\w*\s*\(|^\s*(const|let|var) \w+\s*=|"
+    r"^\s*(public|private|protected)\s+(static\s+)?[\w<>\[\],]+\s+\w+\s*\(|"
+    r"\bSELECT\b.+\bFROM\b|\bINSERT INTO\b|\bUPDATE \w+ SET\b|\bCREATE (TABLE|INDEX|VIEW)\b|"
+    r"\([^()]*\)\s*=>|\w\([^()]*\)\s*\{|\w\([^()]*\)\s*:\s*$|\w\([^()]*\)\s*;\s*$",
+    re.MULTILINE
+)
+# Признаки математики. Деление через «/» без пробелов не учитывается (даты «12/05»),
+# а $...$ считается формулой только с операторами TeX внутри (не «$5 и $10»)
+_MATH_PATTERN = re.compile(
+    r"\\(frac|sum|int|sqrt|lim)|\$[^$]*[\\^_=][^$]*\$|[∑∫√≤≥≠∞π]|\d\s*[\^*]\s*\d|\d\s+/\s+\d|"
+    r"\b\d+\s*[+\-]\s*\d+\s*=|"
+    r"\b(уравнени|интеграл|производн|вероятност|теорем|equation|integral|derivative|"
+    r"probability|theorem)\w*",
+    re.IGNORECASE
+)
+# Просьбы, требующие многошаговых рассуждений
+_REASONING_PATTERN = re.compile(
+    r"\b(докаж|реши(те)?\b|вычисл|рассчита|посчита|оптимизир|алгоритм|отлад|найди ошибк|"
+    r"сравни|проанализир|пошагово|шаг за шагом|prove|solve|calculate|compute|optimi[sz]e|"
+    r"algorithm|debug|compare|analy[sz]e|step by step)\w*",
+    re.IGNORECASE
+)
+# Реплики пользователя, означающие, что предыдущий ответ не устроил
+_RETRY_PATTERN = re.compile(
+    r"\b(неправильн|неверн|не так|не работает|ошибка|подумай|wrong|incorrect|doesn'?t work|think again)\w*",
+    re.IGNORECASE
+)
+
 @lru_cache(maxsize=2)
 def _get_encoding(model):
     """Получение токенизатора с кэшированием"""
@@ -53,7 +96,7 @@ def calculate_cost(model, tokens, token_type="input"):
     Args:
         model: Имя модели
         tokens: Количество токенов
-        token_type: "input" или "output"
+        token_type: "input", "input_cache_hit" или "output"
     
     Returns:
         float: Стоимость с точностью до 6 знаков
@@ -71,3 +114,198 @@ def calculate_cost(model, tokens, token_type="input"):
         # Для других моделей (GPT) оставляем старую логику
         price_per_1k = PRICES.get(model, 0.0015)
         return round((tokens / 1000) * price_per_1k, 6)
+
+def calculate_prompt_cost(model, cache_hit_tokens, cache_miss_tokens):
+    """
+    Стоимость промпта с учетом кэша префикса DeepSeek:
+    попавшие в кэш токены тарифицируются по сниженной цене.
+    
+    Args:
+        model: Имя модели
+        cache_hit_tokens: Количество токенов промпта, взятых из кэша
+        cache_miss_tokens: Количество токенов промпта вне кэша
+    
+    Returns:
+        float: Стоимость с точностью до 6 знаков
+    """
+    hit_cost = 0
+    if cache_hit_tokens and model in ["deepseek-chat", "deepseek-reasoner"]:
+        hit_cost = calculate_cost(model, cache_hit_tokens, token_type="input_cache_hit")
+    elif cache_hit_tokens:
+        hit_cost = calculate_cost(model, cache_hit_tokens, token_type="input")
+    miss_cost = calculate_cost(model, cache_miss_tokens, token_type="input")
+    return round(hit_cost + miss_cost, 6)
+
+def parse_usage(usage, model, messages, tokens_out):
+    """
+    Токены запроса по данным usage из ответа API (с разбивкой на попадания в кэш префикса).
+    Если API не вернул usage, промпт оценивается локально и считается полностью вне кэша.
+    
+    Args:
+        usage: Объект или словарь usage из ответа API, либо None
+        model: Имя модели
+        messages: Отправленные сообщения
+        tokens_out: Локальная оценка числа выходных токенов
+    
+    Returns:
+        dict: prompt_tokens, completion_tokens, cache_hit_tokens, cache_miss_tokens
+    """
+    if usage is None:
+        tokens_in = num_tokens_from_messages(messages, model=model)
+        return {
+            "prompt_tokens": tokens_in,
+            "completion_tokens": tokens_out,
+            "cache_hit_tokens": 0,
+            "cache_miss_tokens": tokens_in
+        }
+
+    def field(name):
+        value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+        return value or 0
+
+    prompt_tokens = field("prompt_tokens")
+    cache_hit_tokens = field("prompt_cache_hit_tokens")
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": field("completion_tokens") or tokens_out,
+        "cache_hit_tokens": cache_hit_tokens,
+        "cache_miss_tokens": field("prompt_cache_miss_tokens") or max(prompt_tokens - cache_hit_tokens, 0)
+    }
+
+class _TokenChunker:
+    """
+    Накопление строк в части не длиннее max_tokens токенов.
+    Части собираются по целым строкам; строка длиннее лимита режется по границам токенов.
+    """
+
+    def __init__(self, max_tokens, model):
+        if not isinstance(max_tokens, int) or max_tokens <= 0:
+            raise ValueError("max_tokens must be positive integer")
+        self.max_tokens = max_tokens
+        self.encoding = _get_encoding(model)
+        self.chunk = []
+        self.chunk_tokens = 0
+
+    def add(self, line):
+        """
+        Добавление строки
+
+        Returns:
+            list: Части, которые заполнены и готовы к обработке
+        """
+        ready = []
+        tokens = self.encoding.encode(line)
+        if len(tokens) > self.max_tokens:
+            ready += self._flush()
+            while len(tokens) > self.max_tokens:
+                end = self._clean_cut(tokens)
+                ready.append(self.encoding.decode(tokens[:end]))
+                tokens = tokens[end:]
+            line = self.encoding.decode(tokens)
+
+        if self.chunk and self.chunk_tokens + len(tokens) > self.max_tokens:
+            ready += self._flush()
+        self.chunk.append(line)
+        self.chunk_tokens += len(tokens)
+        return ready
+
+    def finish(self):
+        """
+        Завершение текста
+
+        Returns:
+            list: Последняя часть, если в ней есть непустой текст
+        """
+        return [chunk for chunk in self._flush() if chunk.strip()]
+
+    def _clean_cut(self, tokens):
+        """
+        Позиция разреза не дальше max_tokens, на которой не рвется символ UTF-8.
+        Токены BPE байтовые: кириллица, CJK и эмодзи могут занимать несколько токенов,
+        и разрез внутри символа дал бы U+FFFD по обе стороны
+        """
+        # Символ UTF-8 занимает не больше 4 байт, поэтому дальше 3 токенов назад искать незачем
+        for end in range(self.max_tokens, max(self.max_tokens - 4, 0), -1):
+            try:
+                self.encoding.decode_bytes(tokens[:end]).decode("utf-8")
+                return end
+            except UnicodeDecodeError:
+                continue
+        return self.max_tokens
+
+    def _flush(self):
+        if not self.chunk:
+            return []
+        chunk = "".join(self.chunk)
+        self.chunk, self.chunk_tokens = [], 0
+        return [chunk]
+
+def split_text_by_tokens(lines, max_tokens, model="gpt-4"):
+    """
+    Разбиение текста на части не длиннее max_tokens токенов.
+    Части собираются по целым строкам; строка длиннее лимита режется по границам токенов.
+    
+    Args:
+        lines: Итерируемые строки текста (с сохраненными переводами строк)
+        max_tokens: Максимальное количество токенов в одной части
+        model: Имя модели для выбора токенизатора
+    
+    Yields:
+        str: Очередная часть текста
+    """
+    chunker = _TokenChunker(max_tokens, model)
+    for line in lines:
+        yield from chunker.add(line)
+    yield from chunker.finish()
+
+async def asplit_text_by_tokens(lines, max_tokens, model="gpt-4"):
+    """
+    То же, что split_text_by_tokens, для асинхронного источника строк:
+    в памяти держится только текущая незаполненная часть
+    
+    Args:
+        lines: Асинхронный итератор строк текста (с сохраненными переводами строк)
+        max_tokens: Максимальное количество токенов в одной части
+        model: Имя модели для выбора токенизатора
+    
+    Yields:
+        str: Очередная часть текста
+    """
+    chunker = _TokenChunker(max_tokens, model)
+    async for line in lines:
+        for chunk in chunker.add(line):
+            yield chunk
+    for chunk in chunker.finish():
+        yield chunk
+
+def choose_model(prompt, history=None):
+    """
+    Быстрый локальный выбор модели для режима auto: простые вопросы уходят
+    в дешевую deepseek-chat, код, математика и многошаговые задачи — в deepseek-reasoner.
+    
+    Args:
+        prompt: Текст запроса пользователя
+        history: Сообщения контекста в формате {"role": "...", "content": "..."}
+    
+    Returns:
+        tuple: (имя модели, причина выбора)
+    """
+    if len(prompt) > AUTO_ROUTE_LONG_PROMPT:
+        return "deepseek-reasoner", "long_prompt"
+    if _CODE_PATTERN.search(prompt):
+        return "deepseek-reasoner", "code"
+    if _MATH_PATTERN.search(prompt):
+        return "deepseek-reasoner", "math"
+    if _REASONING_PATTERN.search(prompt):
+        return "deepseek-reasoner", "reasoning_request"
+
+    if history:
+        # Короткое уточнение к диалогу про код или недовольство прошлым ответом
+        last_assistant = next(
+            (msg["content"] for msg in reversed(history) if msg["role"] == "assistant"), "")
+        if _RETRY_PATTERN.search(prompt):
+            return "deepseek-reasoner", "retry"
+        if "```" in last_assistant and len(prompt) < 200:
+            return "deepseek-reasoner", "code_followup"
+
+    return "deepseek-chat", "simple"